@@ -82,6 +82,7 @@ def main(simulationDataFrameCSVFile):
         fig2 = Figure("/home/aholaj/Nextcloud/kuvatesti","Nc_ic")
         # load ts-datasets and change their time coordinates to hours
         sensitive = ["ICE0_8h","ICE1_24h","ICE2_24h","ICE3_24h","ICE3_8h","ICE4_24h","ICE5_8h","ICE6_8h", "Prognostic_48h"]
+        InputSimulation.prefetchSimulationCollection( { k : simulationCollection[k] for k in sensitive }, kinds = ["ts"] )
         for k in sensitive:
             simulationCollection[k].getTSDataset()
             simulationCollection[k].setTimeCoordToHours()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 11:02:15 2026
+
+@author: Jaakko Ahola, Finnish Meteorological Institute
+@licence: MIT licence Copyright
+"""
+import collections.abc
+import numpy
+import pandas
+
+class ConditionSet(collections.abc.MutableMapping):
+    """
+    Dictionary of named boolean conditions stored as packed bit arrays.
+    
+    Works wherever Data.getAllConditions, getORConditions, getNANDConditions and
+    getNLengthSubsetConditions expect a dictionary of conditions. Compound expressions
+    are evaluated on the packed bits and every evaluated sub-expression is memoized, e.g.
+    conditions.evaluate( ("and", "lwp", ("or", "cdnc", ("not", "pblh"))) ).
+    Conditions are returned in the type of the first stored condition
+    (pandas.Series, xarray.DataArray or numpy array).
+    """
+    
+    def __init__(self, condition : dict = None):
+        self.template = None
+        self.length = None
+        self.packedConditions = {}
+        self.evaluated = {}
+        
+        if condition is not None:
+            for key in condition:
+                self[key] = condition[key]
+    
+    def __setitem__(self, name, mask):
+        if self.template is None:
+            if isinstance(mask, pandas.Series):
+                self.template = mask.index
+            elif hasattr(mask, "dims"):
+                self.template = mask
+        
+        if isinstance(mask, pandas.Series):
+            values = mask.reindex(self.template, fill_value = False).to_numpy(dtype = bool)
+        else:
+            values = numpy.asarray(mask, dtype = bool).ravel()
+        
+        if self.length is None:
+            self.length = values.shape[0]
+        elif values.shape[0] != self.length:
+            raise ValueError(f"Condition {name} has length {values.shape[0]}, expected {self.length}")
+        
+        self.packedConditions[name] = numpy.packbits(values)
+        self.evaluated = {}
+    
+    def __getitem__(self, name):
+        return self._wrap(self._unpack(self.packedConditions[name]))
+    
+    def __delitem__(self, name):
+        del self.packedConditions[name]
+        self.evaluated = {}
+    
+    def __iter__(self):
+        return iter(self.packedConditions)
+    
+    def __len__(self):
+        return len(self.packedConditions)
+    
+    def evaluate(self, expression):
+        """
+        expression is a condition name or a tuple (operator, *operands)
+        with operator "and", "or", "nand" (all operands False) or "not"
+        """
+        return self._wrap(self._unpack(self._evaluatePacked(expression)))
+    
+    def getAllConditions(self, names = None):
+        return self.evaluate( ("and", *self._getNames(names)) )
+    
+    def getORConditions(self, names = None):
+        return self.evaluate( ("or", *self._getNames(names)) )
+    
+    def getNANDConditions(self, names = None):
+        return self.evaluate( ("nand", *self._getNames(names)) )
+    
+    def getStackedConditions(self, names = None):
+        """
+        returns the index template and a (condition, element) boolean array of the conditions
+        """
+        packed = numpy.stack([self.packedConditions[name] for name in self._getNames(names)])
+        stacked = numpy.unpackbits(packed, axis = 1, count = self.length).astype(bool)
+        
+        return self.template, stacked
+    
+    def _getNames(self, names):
+        if names is None:
+            names = list(self.packedConditions)
+        return names
+    
+    def _evaluatePacked(self, expression):
+        if isinstance(expression, str):
+            return self.packedConditions[expression]
+        
+        operator, *operands = expression
+        if operator in ["and", "or", "nand"]:
+            operands = sorted(operands, key = repr)
+        key = (operator, *operands)
+        
+        if key not in self.evaluated:
+            packedOperands = [self._evaluatePacked(operand) for operand in operands]
+            
+            if operator == "not":
+                result = numpy.invert(packedOperands[0])
+            elif operator == "and":
+                result = numpy.bitwise_and.reduce(packedOperands)
+            elif operator == "or":
+                result = numpy.bitwise_or.reduce(packedOperands)
+            elif operator == "nand":
+                result = numpy.invert(numpy.bitwise_or.reduce(packedOperands))
+            else:
+                raise ValueError(f"Unknown operator {operator}")
+            
+            self.evaluated[key] = result
+        
+        return self.evaluated[key]
+    
+    def _unpack(self, packed):
+        return numpy.unpackbits(packed, count = self.length).astype(bool)
+    
+    def _wrap(self, values):
+        if isinstance(self.template, pandas.Index):
+            return pandas.Series(values, index = self.template)
+        elif self.template is not None:
+            return self.template.copy(data = values.reshape(self.template.shape))
+        else:
+            return values
@@ -12,14 +12,23 @@ import math
 import numpy
 import operator
 import pandas
+import statistics
+import xarray
 
 
 
 from collections import defaultdict
 
+from ConditionSet import ConditionSet
+from QuantileSketch import QuantileSketch
+from Ranking import Ranking
+
 
 class Data:
     def getAllConditions( condition : dict ):
+        if isinstance(condition, ConditionSet):
+            return condition.getAllConditions()
+
         allConditions = None
         for ind, key in enumerate(list(condition)):
             if ind == 0:
@@ -30,6 +39,9 @@ class Data:
         return allConditions
 
     def getORConditions( condition : dict ):
+        if isinstance(condition, ConditionSet):
+            return condition.getORConditions()
+
         allConditions = None
         for ind, key in enumerate(list(condition)):
             if ind == 0:
@@ -40,6 +52,9 @@ class Data:
         return allConditions
 
     def getNANDConditions( condition : dict ):
+        if isinstance(condition, ConditionSet):
+            return condition.getNANDConditions()
+
         allConditions = None
         for ind, key in enumerate(list(condition)):
             if ind == 0:
@@ -50,24 +65,52 @@ class Data:
         return allConditions
 
     def getNLengthSubsetConditions( condition : dict, n :int):
-        allSubsets = Data.getNLengthSubsetsOfList(list(condition), n)
+        """True where at least n of the conditions are True,
+i.e. the OR of the ANDs of all n-length subsets of conditions"""
+        if n < 1 or n > len(condition):
+            return None
 
-        orSubsetConditions = None
+        return Data.getAtLeastKConditions(condition, n)
 
-        for ind, subset in enumerate(allSubsets):
-            subsetDictionary = Data.subdict(condition, subset)
+    def getConditionCount( condition : dict ):
+        """returns the number of True conditions per element in the type of the conditions
+(pandas.Series, xarray.DataArray or numpy array)"""
+        template, stackedConditions = Data._stackConditions(condition)
 
-            subsetCondition = Data.getAllConditions(subsetDictionary)
+        return Data._wrapCondition(template, stackedConditions.sum(axis = 0, dtype = numpy.int32))
 
-            if ind == 0:
-                orSubsetConditions  = subsetCondition
-            else:
-                orSubsetConditions = orSubsetConditions | subsetCondition
+    def getAtLeastKConditions( condition : dict, k : int):
+        return Data.getConditionCount(condition) >= k
 
-        return orSubsetConditions
+    def getExactlyKConditions( condition : dict, k : int):
+        return Data.getConditionCount(condition) == k
 
+    def getAtMostKConditions( condition : dict, k : int):
+        return Data.getConditionCount(condition) <= k
 
+    def _stackConditions( condition : dict ):
+        """returns the aligned index template and a (condition, element) boolean array of the conditions"""
+        if isinstance(condition, ConditionSet):
+            return condition.getStackedConditions()
 
+        masks = [condition[key] for key in condition]
+
+        if isinstance(masks[0], pandas.Series):
+            frame = pandas.concat(masks, axis = 1).fillna(False)
+            return frame.index, frame.to_numpy(dtype = bool).T
+        elif hasattr(masks[0], "dims"):
+            masks = xarray.align(*masks, join = "inner")
+            return masks[0], numpy.stack([mask.values for mask in masks]).astype(bool)
+        else:
+            return None, numpy.stack([numpy.asarray(mask) for mask in masks]).astype(bool)
+
+    def _wrapCondition(template, values):
+        if isinstance(template, pandas.Index):
+            return pandas.Series(values, index = template)
+        elif template is not None:
+            return template.copy(data = values.reshape(template.shape))
+        else:
+            return values
 
     def listAll2ChoicesFromList(lista : list, n : int):
         choices = []
@@ -78,35 +121,23 @@ class Data:
         return choices
 
     def getNLengthSubsetsOfList(arr : list, k : int):
-        subsets = []
-        # Function to find all subsets of given set.
-        # Any repeated subset is considered only
-        # once in the output
-        _list = []
-        n = len(arr)
-        # Run counter i from 000..0 to 111..1
-        for i in range(2**n):
-            subset = []
-
-            # consider each element in the set
-            for j in range(n):
-
-                # Check if jth bit in the i is set.
-                # If the bit is set, we consider
-                # jth element from set
-                if (i & (1 << j)) != 0:
-                    subset.append(arr[j])
-
-            # if subset is encountered for the first time
-            # If we use set<string>, we can directly insert
-            if subset not in _list and len(subset) > 0:
-                _list.append(subset)
-        # print(_list)
-        # consider every subset
-        for subset in _list:
-            if len(subset) == k:
-                subsets.append(subset)
-        return subsets
+        return list(Data.iterNLengthSubsetsOfList(arr, k))
+
+    def iterNLengthSubsetsOfList(arr : list, k : int):
+        """yields the k-length subsets of arr as lists lazily,
+any repeated subset is yielded only once"""
+        if k < 1:
+            return
+
+        seen = set()
+        for subset in itertools.combinations(arr, k):
+            try:
+                if subset in seen:
+                    continue
+                seen.add(subset)
+            except TypeError:
+                pass
+            yield list(subset)
 
     def subdict(dictionary, keys):
         vals = []
@@ -122,6 +153,73 @@ class Data:
     def getClosestIndex(dataarray, searchValue):
         return numpy.argmin(numpy.abs(searchValue- dataarray))
 
+    def getClosestIndexSorted(sortedArray, searchValues, sorter = None):
+        """returns the indexes of the elements of sortedArray (ascending) closest to searchValues
+using a binary search, on ties the smaller index is returned like in getClosestIndex.
+If sorter (e.g. numpy.argsort(array, kind = "stable")) is given, sortedArray may be unsorted."""
+        sortedArray = numpy.asarray(sortedArray)
+        searchValues = numpy.asarray(searchValues)
+
+        if sorter is not None:
+            sortedArray = sortedArray[sorter]
+
+        if sortedArray.shape[0] < 2:
+            return numpy.zeros(searchValues.shape, dtype = int)
+
+        right = numpy.clip(numpy.searchsorted(sortedArray, searchValues), 1, sortedArray.shape[0] - 1)
+        left = right - 1
+
+        leftDistance = numpy.abs(searchValues - sortedArray[left])
+        rightDistance = numpy.abs(sortedArray[right] - searchValues)
+
+        # first occurrence of repeated values and the smaller original index on ties
+        left = numpy.searchsorted(sortedArray, sortedArray[left])
+        right = numpy.searchsorted(sortedArray, sortedArray[right])
+
+        if sorter is None:
+            return numpy.where(leftDistance <= rightDistance, left, right)
+
+        useLeft = (leftDistance < rightDistance) | ((leftDistance == rightDistance) & (sorter[left] < sorter[right]))
+
+        return sorter[numpy.where(useLeft, left, right)]
+
+    def getDecimatedIndexes(x, y, buckets : int, xmin = None, xmax = None):
+        """returns sorted indexes of the points of the series (x ascending, y) that keep its shape
+when drawn with the given number of pixel columns (buckets) between xmin and xmax:
+the first, last, minimum and maximum point of each column (M4 decimation).
+The first NaN of each gap is kept so that the gaps remain visible."""
+        x = numpy.asarray(x, dtype = float)
+        y = numpy.asarray(y, dtype = float)
+
+        if y.shape[0] <= 4*buckets:
+            return numpy.arange(y.shape[0])
+
+        if xmin is None:
+            xmin = x[0]
+        if xmax is None:
+            xmax = x[-1]
+
+        finite = numpy.isfinite(y)
+        finiteIndexes = numpy.flatnonzero(finite)
+        if finiteIndexes.shape[0] == 0:
+            return numpy.arange(y.shape[0])
+
+        bucket = numpy.clip(((x[finiteIndexes] - xmin) / max(xmax - xmin, numpy.finfo(float).eps) * buckets).astype(int),
+                            0, buckets - 1)
+
+        bucketStarts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(bucket)) + 1))
+        bucketEnds = numpy.concatenate((bucketStarts[1:] - 1, [bucket.shape[0] - 1]))
+
+        order = numpy.lexsort((y[finiteIndexes], bucket))
+        minimums = order[bucketStarts]
+        maximums = order[bucketEnds]
+
+        gapStarts = numpy.flatnonzero(~finite[1:] & finite[:-1]) + 1
+
+        return numpy.unique(numpy.concatenate((finiteIndexes[bucketStarts], finiteIndexes[bucketEnds],
+                                               finiteIndexes[minimums], finiteIndexes[maximums],
+                                               gapStarts)))
+
     def getColorBin(colorArray, bini, data):
         if any(bindim in data.dims for bindim in ['aeb', 'cla', 'clb', 'ica', 'icb']):
             bini = bini + 3
@@ -200,20 +298,34 @@ class Data:
         return levels, rangePotenssi, minimiPotenssi, maksimiPotenssi
 
 
-    def getMaskedList(bigList : list, shortList, initial = False):
+    def getMaskedList(bigList : list, shortList, initial = False, sorter = None):
         """returns a maskedList where bigList values are masked with a boolean value
 True if element from bigList closest to an element from shortList
 e.g. bigList = [0,1,2,3,4], shortList = [2,4]
-returns [False, False, True, False, True]"""
+returns numpy.array([False, False, True, False, True])
+sorter is an optional precomputed numpy.argsort(bigList, kind = "stable")"""
+        return Data.getMaskedLists(bigList, [shortList], initial, sorter)[0]
+
+    def getMaskedLists(bigList : list, shortLists : list, initial = False, sorter = None):
+        """batch form of getMaskedList, returns a (len(shortLists), len(bigList)) boolean array
+with one row per short list"""
         bigList = numpy.asarray(bigList)
-        maskedList = [initial]*numpy.shape(bigList)[0]
+        maskedLists = numpy.full((len(shortLists), numpy.shape(bigList)[0]), initial, dtype = bool)
+
+        if sorter is None and numpy.any(numpy.diff(bigList) < 0):
+            sorter = numpy.argsort(bigList, kind = "stable")
 
-        indexes = [ numpy.argmin(numpy.abs(elem - bigList)) for elem in shortList ]
+        shortArrays = [numpy.atleast_1d(numpy.asarray(shortList, dtype = float)) for shortList in shortLists]
+        if len(shortArrays) == 0:
+            return maskedLists
 
-        for i in indexes:
-            maskedList[i] = (not initial)
+        rows = numpy.repeat(numpy.arange(len(shortArrays)), [shortArray.shape[0] for shortArray in shortArrays])
+        indexes = Data.getClosestIndexSorted(bigList, numpy.concatenate(shortArrays), sorter)
+
+        maskedLists[rows, indexes] = (not initial)
+
+        return maskedLists
 
-        return maskedList
     def getIntergerList(start, end, interval):
         integerList = [ int(elem) for elem in numpy.arange(start, end + interval*0.1, interval) ]
         return integerList
@@ -247,6 +359,34 @@ returns [False, False, True, False, True]"""
 
         return zero
 
+    def isCloseToEpsilonColumns(array : numpy.array, limit = numpy.finfo(float).eps ):
+        """isCloseToEpsilon of each column of a (time, bin) array in one pass, NaN values are skipped"""
+        array = numpy.asarray(array)
+        with numpy.errstate(invalid = "ignore"):
+            return numpy.abs(numpy.nanmax(array, axis = 0) - numpy.nanmin(array, axis = 0)) < limit
+
+    def getFirstIndexNotBelow(array : numpy.array, limiter = 0):
+        """returns the first index along axis 0 of each column where the value is not below limiter
+like the search in getRelativeChange, -1 if there is none"""
+        notBelow = ~(numpy.asarray(array) < limiter)
+        indexes = numpy.argmax(notBelow, axis = 0)
+
+        return numpy.where(notBelow.any(axis = 0), indexes, -1)
+
+    def getRelativeChanges(dataarray, denominator = None, limiter = 0):
+        """getRelativeChange of each column of a (time, bin) dataarray at once,
+returns the normalised dataarray and the starting values (NaN for columns without one)"""
+        if denominator is None:
+            denominator = numpy.asarray(dataarray)
+        denominator = numpy.asarray(denominator)
+
+        indexes = Data.getFirstIndexNotBelow(denominator, limiter)
+        lahtoarvot = numpy.where(indexes >= 0,
+                                 numpy.take_along_axis(denominator, numpy.maximum(indexes, 0)[numpy.newaxis, :], axis = 0)[0],
+                                 numpy.nan)
+
+        return dataarray/lahtoarvot, lahtoarvot
+
     def sortDictionary(dictionary : dict):
         sortedDict = {k: v for k, v in sorted(dictionary.items(), key=lambda item: item[1])}
         return sortedDict
@@ -254,11 +394,17 @@ returns [False, False, True, False, True]"""
     def getHighAndLowTail(dictionary : dict,
                 fraction : float):
 
+        if isinstance(dictionary, Ranking):
+            return dictionary.getHighAndLowTail(fraction)
+
         return { **Data.getLowTail(dictionary, fraction), **Data.getHighTail(dictionary, fraction) }
 
     def getLowTail(dictionary : dict,
                 fraction : float):
 
+        if isinstance(dictionary, Ranking):
+            return dictionary.getLowTail(fraction)
+
         tailDict = {}
         keyList = list(dictionary)[:int(len(dictionary)*fraction)]
 
@@ -270,6 +416,9 @@ returns [False, False, True, False, True]"""
     def getHighTail(dictionary : dict,
                 fraction : float):
 
+        if isinstance(dictionary, Ranking):
+            return dictionary.getHighTail(fraction)
+
         tailDict = {}
         keyList = list(dictionary)[-int(len(dictionary)*fraction):]
 
@@ -290,7 +439,15 @@ returns [False, False, True, False, True]"""
     def date(format="%Y-%m-%d"):
         return datetime.datetime.utcnow().strftime(format)
 
-    def mergeDataFrameWithParam(dataFrame, paramDict, paramName):
+    def mergeDataFrameWithParam(dataFrame, paramDict, paramName, bulk = False):
+        """
+        dataFrame : dict of case -> DataFrame indexed by ID
+        paramDict : dict of case -> dict of ID -> parameter value
+        bulk : merge all cases at once with one join on (case, ID)
+        """
+        if bulk:
+            return Data._mergeDataFrameWithParamBulk(dataFrame, paramDict, paramName)
+
         for ind, case in enumerate(list(dataFrame)):
             paramDataFrame  = pandas.DataFrame({"ID":list(paramDict[case]),
                                   paramName : list(paramDict[case].values())})
@@ -300,33 +457,84 @@ returns [False, False, True, False, True]"""
 
         return dataFrame
 
-    def outliersFromDataFrame(dataframe : pandas.DataFrame , variable : str, outlierFrac : float):
+    def _mergeDataFrameWithParamBulk(dataFrame, paramDict, paramName):
+        cases = list(dataFrame)
+
+        long = pandas.concat([dataFrame[case].drop(columns = "ID") for case in cases],
+                             keys = cases, names = ["case", "ID"]).reset_index()
+        long["case"] = pandas.Categorical(long["case"], categories = cases)
 
-        low = dataframe[variable].quantile( outlierFrac )
-        high  = dataframe[variable].quantile(1.-outlierFrac)
+        paramCases = [case for case in cases if case in paramDict]
+        params = pandas.DataFrame({"case" : pandas.Categorical(numpy.repeat(paramCases, [len(paramDict[case]) for case in paramCases]),
+                                                               categories = cases),
+                                   "ID" : [key for case in paramCases for key in paramDict[case]],
+                                   paramName : [value for case in paramCases for value in paramDict[case].values()]})
 
-        if high < low:
-            apu = low
-            low = high
-            high = apu
+        merged = pandas.merge(long, params, on = ["case", "ID"])
+        caseIndexes = merged.groupby("case", observed = True, sort = False).indices
+        merged = merged.drop(columns = "case")
 
+        for case in cases:
+            dataFrame[case] = merged.take(caseIndexes.get(case, [])).reset_index(drop = True)
 
+        return dataFrame
 
-        return dataframe[( dataframe[variable] < low ) | (dataframe[variable] > high  )]
+    def getQuantileSummary(dataframe, variables : list, quantiles : list):
+        """returns a DataFrame of quantiles (index) by variables (columns) computed in one pass
+dataframe can also be a dictionary variable -> QuantileSketch for approximate quantiles"""
+        if not isinstance(dataframe, pandas.DataFrame):
+            return QuantileSketch.getQuantileSummary(dataframe, variables, quantiles)
 
+        return dataframe[list(variables)].quantile(sorted(set(quantiles)))
 
-    def midQuantileFromDataFrame(dataframe : pandas.DataFrame , variable : str, outlierFrac : float): #variable  < 0.5
+    def getOutlierQuantiles(outlierFracs : list):
+        """returns the quantiles needed for outlierFracs"""
+        return sorted(set(outlierFracs) | {1. - outlierFrac for outlierFrac in outlierFracs})
+
+    def getOutlierMasks(dataframe : pandas.DataFrame, variables : list, outlierFracs : list, summary = None):
+        """returns a boolean DataFrame with (variable, outlierFrac) columns
+True where the value is below the outlierFrac or above the 1-outlierFrac quantile
+summary is an optional precomputed Data.getQuantileSummary e.g. from sketches"""
+        return Data._getQuantileMasks(dataframe, variables, outlierFracs, summary, outside = True)
+
+    def getMidQuantileMasks(dataframe : pandas.DataFrame, variables : list, outlierFracs : list, summary = None):
+        """returns a boolean DataFrame with (variable, outlierFrac) columns
+True where the value is strictly between the outlierFrac and 1-outlierFrac quantiles"""
+        return Data._getQuantileMasks(dataframe, variables, outlierFracs, summary, outside = False)
 
-        low = dataframe[variable].quantile( outlierFrac )
-        high  = dataframe[variable].quantile(1.-outlierFrac)
+    def _getQuantileMasks(dataframe, variables, outlierFracs, summary, outside):
+        if summary is None:
+            summary = Data.getQuantileSummary(dataframe, variables, Data.getOutlierQuantiles(outlierFracs))
 
-        if high < low:
-            apu = low
-            low = high
-            high = apu
+        masks = {}
+        for variable in variables:
+            values = dataframe[variable]
+            for outlierFrac in outlierFracs:
+                low = summary.loc[outlierFrac, variable]
+                high = summary.loc[1. - outlierFrac, variable]
 
+                if high < low:
+                    low, high = high, low
+
+                if outside:
+                    masks[(variable, outlierFrac)] = (values < low) | (values > high)
+                else:
+                    masks[(variable, outlierFrac)] = (values > low) & (values < high)
+
+        return pandas.DataFrame(masks, index = dataframe.index)
+
+    def outliersFromDataFrame(dataframe : pandas.DataFrame , variable : str, outlierFrac : float):
 
-        return dataframe[( dataframe[variable] >  low ) & ( dataframe[variable] < high  )]
+        masks = Data.getOutlierMasks(dataframe, [variable], [outlierFrac])
+
+        return dataframe[ masks[(variable, outlierFrac)] ]
+
+
+    def midQuantileFromDataFrame(dataframe : pandas.DataFrame , variable : str, outlierFrac : float): #variable  < 0.5
+
+        masks = Data.getMidQuantileMasks(dataframe, [variable], [outlierFrac])
+
+        return dataframe[ masks[(variable, outlierFrac)] ]
 
     def cycleBoolean(numberOfElements, startBoolean = True):
         cyclableValues = itertools.cycle([ startBoolean, not startBoolean])
@@ -380,8 +588,14 @@ returns [False, False, True, False, True]"""
 
         return durationStr
 
-    def confidenceInterval(data, level = 1):
-        if level == 1: #95%
+    def getConfidenceRate(confidence = 0.95):
+        """returns the two-sided normal z-value of confidence, e.g. 0.95 -> 1.96"""
+        return statistics.NormalDist().inv_cdf(0.5 + confidence / 2.)
+
+    def confidenceInterval(data, level = 1, confidence = None):
+        if confidence is not None:
+            rate = Data.getConfidenceRate(confidence)
+        elif level == 1: #95%
             rate = 1.96
         elif level == 2: #99%
             rate = 2.58
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 14:25:31 2026
+
+@author: Jaakko Ahola, Finnish Meteorological Institute
+@licence: MIT licence Copyright
+"""
+import concurrent.futures
+import numpy
+import xarray
+
+from Data import Data
+
+class EnsembleStatistics:
+    """
+    Running per-time-step count, mean and variance (Welford) of one TS variable over an
+    ensemble of simulations, read one simulation at a time.
+
+    The time axis (seconds) is the union of the time axes seen so far, time steps missing
+    from a simulation or NaN values do not count. Accumulators of separate workers are
+    combined with merge, e.g. EnsembleStatistics.fromSimulationCollection(collection, "lwp_bar").
+    """
+
+    def __init__(self, variable = None):
+        self.variable = variable
+        self.time = numpy.empty(0)
+        self.count = numpy.empty(0)
+        self.mean = numpy.empty(0)
+        self.m2 = numpy.empty(0)
+
+    def update(self, time, values):
+        """adds one timeseries (values at time in seconds) or a (series, time) array of them"""
+        values = numpy.atleast_2d(numpy.asarray(values, dtype = float))
+        valid = ~numpy.isnan(values)
+
+        count = valid.sum(axis = 0)
+        total = numpy.where(valid, values, 0.).sum(axis = 0)
+        mean = numpy.divide(total, count, out = numpy.zeros(count.shape), where = count > 0)
+        m2 = numpy.where(valid, (values - mean)**2, 0.).sum(axis = 0)
+
+        self._addMoments(numpy.asarray(time, dtype = float), count, mean, m2)
+
+        return self
+
+    def merge(self, other):
+        """adds the statistics of other EnsembleStatistics of the same variable"""
+        self._addMoments(other.time, other.count, other.mean, other.m2)
+
+        return self
+
+    def addSimulation(self, simulation, conversionFactor = 1.0):
+        """reads the variable from the TS file of simulation without storing the dataset"""
+        try:
+            ts = simulation.openDataset("ts")
+        except FileNotFoundError:
+            print("FileNotFoundError", simulation.getLabel(), simulation.getFolder(), "EnsembleStatistics.addSimulation")
+            return self
+
+        with ts:
+            if self.variable not in ts:
+                print("KeyError", simulation.getLabel(), self.variable, "EnsembleStatistics.addSimulation")
+                return self
+            self.update(ts["time"].values, ts[self.variable].values*conversionFactor)
+
+        return self
+
+    def fromSimulationCollection(simulationCollection : dict, variable, conversionFactor = 1.0,
+                                 maxWorkers = None, useProcesses = False):
+        """
+        Accumulates variable over simulationCollection (ID -> Simulation) on a thread
+        pool (or a process pool if useProcesses), one accumulator per simulation merged as they finish.
+        """
+        if useProcesses:
+            executorClass = concurrent.futures.ProcessPoolExecutor
+        else:
+            executorClass = concurrent.futures.ThreadPoolExecutor
+
+        statistics = EnsembleStatistics(variable)
+        with executorClass(max_workers = maxWorkers) as executor:
+            futures = [executor.submit(EnsembleStatistics._accumulate, simulation, variable, conversionFactor)
+                       for simulation in simulationCollection.values()]
+
+            for future in concurrent.futures.as_completed(futures):
+                statistics.merge(future.result())
+
+        return statistics
+
+    def _accumulate(simulation, variable, conversionFactor):
+        return EnsembleStatistics(variable).addSimulation(simulation, conversionFactor)
+
+    def getTime(self, unit = "h"):
+        if unit == "h":
+            return self.time / 3600
+        elif unit == "s":
+            return self.time
+        else:
+            raise ValueError(f"Unknown time unit {unit}")
+
+    def getCount(self):
+        return self.count
+
+    def getMean(self):
+        return numpy.where(self.count > 0, self.mean, numpy.nan)
+
+    def getVariance(self):
+        """sample variance (ddof = 1)"""
+        return numpy.divide(self.m2, self.count - 1, out = numpy.full(self.count.shape, numpy.nan), where = self.count > 1)
+
+    def getStd(self):
+        return numpy.sqrt(self.getVariance())
+
+    def getConfidenceBand(self, confidence = 0.95):
+        """returns low and high of the normal confidence interval of the mean like Data.confidenceInterval"""
+        diff = Data.getConfidenceRate(confidence)*self.getStd() / numpy.sqrt(numpy.where(self.count > 0, self.count, numpy.nan))
+        mean = self.getMean()
+
+        return mean - diff, mean + diff
+
+    def getDataset(self, confidence = 0.95, unit = "h"):
+        """returns a Dataset of count, mean, std, low and high with time in unit"""
+        low, high = self.getConfidenceBand(confidence)
+
+        return xarray.Dataset({"count" : ("time", self.count.astype(int)),
+                               "mean" : ("time", self.getMean()),
+                               "std" : ("time", self.getStd()),
+                               "low" : ("time", low),
+                               "high" : ("time", high)},
+                              coords = {"time" : ("time", self.getTime(unit), {"units" : unit})},
+                              attrs = {"variable" : str(self.variable), "confidence" : confidence})
+
+    def _addMoments(self, time, count, mean, m2):
+        if not numpy.array_equal(time, self.time):
+            newTime = numpy.union1d(self.time, time)
+            if newTime.shape[0] != self.time.shape[0]:
+                self._reindex(newTime)
+            time, count, mean, m2 = self._expand(time, count, mean, m2)
+
+        total = self.count + count
+        delta = mean - self.mean
+        weight = numpy.divide(count, total, out = numpy.zeros(total.shape), where = total > 0)
+
+        self.mean = self.mean + delta*weight
+        self.m2 = self.m2 + m2 + delta**2*self.count*weight
+        self.count = total
+
+    def _reindex(self, newTime):
+        indexes = numpy.searchsorted(newTime, self.time)
+        self.count, self.mean, self.m2 = [self._scatter(newTime.shape[0], indexes, values)
+                                          for values in (self.count, self.mean, self.m2)]
+        self.time = newTime
+
+    def _expand(self, time, count, mean, m2):
+        indexes = numpy.searchsorted(self.time, time)
+        return (self.time, *[self._scatter(self.time.shape[0], indexes, values) for values in (count, mean, m2)])
+
+    def _scatter(self, length, indexes, values):
+        scattered = numpy.zeros(length)
+        scattered[indexes] = values
+        return scattered
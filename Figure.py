@@ -6,22 +6,51 @@ Created on Fri Jan 10 13:16:21 2020
 @author: Jaakko Ahola, Finnish Meteorological Institute
 @licence: MIT licence Copyright
 """
+import concurrent.futures
+import contextlib
 import matplotlib
+import matplotlib.backends.backend_agg
+import matplotlib.figure
+import matplotlib.gridspec
+import matplotlib.pyplot
+import matplotlib.style
 import numpy
 import pathlib
+import PIL.Image
 import seaborn
 import sys
+import threading
 
 class Figure:
     
+    # rc parameters that are not part of a style, as in matplotlib.style
+    _nonStyleParameters = {"backend", "backend_fallback", "interactive", "toolbar", "timezone",
+                           "figure.max_open_warning", "figure.raise_window", "savefig.directory",
+                           "tk.window_focus", "docstring.hardcopy", "date.epoch", "webagg.port",
+                           "webagg.address", "webagg.port_retries", "webagg.open_in_browser"}
+    
+    _rcLock = threading.RLock()
+    
     def __init__(self, figurefolder, name,
                  nrows = 1, ncols =1, sharex=False, sharey=False, style = "seaborn-paper",
                  figsize = None,width = None,
                  wspace=0.3, hspace=0.12, 
-                 top = 0.985, left = 0.12, right=0.97, bottom = 0.1
+                 top = 0.985, left = 0.12, right=0.97, bottom = 0.1,
+                 usePyplot = True
                  ):
+        """
+        usePyplot : bool
+            True: the figure is created with pyplot and the style is set to the global rcParams.
+            False: the figure is a matplotlib.figure.Figure with its own Agg canvas, nothing
+            is registered to pyplot and the global rcParams are not changed. The style is
+            kept in getContext() and applied with "with figure.rcContext():" while adding
+            artists, so figures can be built in parallel threads.
+        """
+        self.usePyplot = usePyplot
+        self.context = Figure.getStyleContext(style)
         
-        self._setContext(style)
+        if self.usePyplot:
+            self.setGlobalContext()
         
         self.figurefolder = pathlib.Path(figurefolder)
         self.name = name
@@ -38,21 +67,27 @@ class Figure:
             self.figsize = figsize
         
         
-        self.fig = matplotlib.pyplot.figure(figsize=self.figsize, constrained_layout=False)
-        self.grid = matplotlib.gridspec.GridSpec(nrows, ncols,
-                                            wspace=wspace, hspace=hspace, 
-                                            top = top, left = left, right = right, bottom = bottom)
-        
-        self.coords = numpy.arange(ncols*nrows).reshape(nrows,ncols)
-        
-        self.axesList = []
-        
-        self.axesPseudoList = []
-        
-        for yCoord in range(nrows):
-            for xCoord in range(ncols):
-                self.axesList.append(matplotlib.pyplot.subplot( self.grid[yCoord,xCoord] ))
-                self.axesPseudoList.append([yCoord,xCoord])
+        with self.rcContext():
+            if self.usePyplot:
+                self.fig = matplotlib.pyplot.figure(figsize=self.figsize, constrained_layout=False)
+            else:
+                self.fig = matplotlib.figure.Figure(figsize=self.figsize, constrained_layout=False)
+                matplotlib.backends.backend_agg.FigureCanvasAgg(self.fig)
+            
+            self.grid = matplotlib.gridspec.GridSpec(nrows, ncols, figure = self.fig,
+                                                wspace=wspace, hspace=hspace, 
+                                                top = top, left = left, right = right, bottom = bottom)
+            
+            self.coords = numpy.arange(ncols*nrows).reshape(nrows,ncols)
+            
+            self.axesList = []
+            
+            self.axesPseudoList = []
+            
+            for yCoord in range(nrows):
+                for xCoord in range(ncols):
+                    self.axesList.append(self.fig.add_subplot( self.grid[yCoord,xCoord] ))
+                    self.axesPseudoList.append([yCoord,xCoord])
         
         self.oldContextValues = {}
     
@@ -77,34 +112,86 @@ class Figure:
     
     def getOldContextValues(self):
         return self.oldContextValues
+    
+    def getContext(self):
+        return self.context
 
     def modifyContext(self, parameter, factorForOldValue = None, newValue = None):
-        self.oldContextValues[ parameter ] = matplotlib.rcParams[parameter]
+        """modifies the global rcParams with usePyplot, otherwise only the context of this figure"""
+        if self.usePyplot:
+            rcParams = matplotlib.rcParams
+        else:
+            rcParams = self.context
+        
+        self.oldContextValues[ parameter ] = rcParams[parameter]
         
         if factorForOldValue is not None:
-            matplotlib.rcParams[ parameter ] = Figure._modifyContextFactor(parameter, factorForOldValue)
+            rcParams[ parameter ] = Figure._modifyContextFactor(parameter, factorForOldValue, rcParams)
         elif newValue is not None:
-            matplotlib.rcParams[ parameter ] = newValue
+            rcParams[ parameter ] = newValue
             
 
-    def _modifyContextFactor(parameter, factorForOldValue ):
-        if isinstance(matplotlib.rcParams[parameter], int):
-            newValue = matplotlib.rcParams[parameter] * factorForOldValue
+    def _modifyContextFactor(parameter, factorForOldValue, rcParams = None ):
+        if rcParams is None:
+            rcParams = matplotlib.rcParams
+        
+        if isinstance(rcParams[parameter], int):
+            newValue = rcParams[parameter] * factorForOldValue
             
-        elif isinstance(matplotlib.rcParams[parameter], list):
-            newValue = list(numpy.asarray(matplotlib.rcParams[parameter])*factorForOldValue)
+        elif isinstance(rcParams[parameter], list):
+            newValue = list(numpy.asarray(rcParams[parameter])*factorForOldValue)
             
         return newValue
-
-    def _setContext(self, style = "seaborn-paper", printing = False):
-        matplotlib.rcParams.update(matplotlib.rcParamsDefault)
-        matplotlib.pyplot.style.use(style)
+    
+    @contextlib.contextmanager
+    def rcContext(self):
+        """
+        applies the context of the figure inside the with block, in pyplot mode the
+        global rcParams are used as they are
+        """
+        if self.usePyplot:
+            yield
+        else:
+            with Figure._rcLock, matplotlib.rc_context(self.context):
+                yield
+    
+    def setGlobalContext(self):
+        """sets the context of the figure to the global rcParams"""
+        matplotlib.rcParams.update(self.context)
+    
+    def getStyleContext(style = "seaborn-paper"):
+        """
+        returns the rc parameters of the matplotlib defaults updated with style and
+        the settings of this library without changing the global rcParams
+        """
+        context = {parameter : value for parameter, value in matplotlib.rcParamsDefault.items()
+                   if parameter not in Figure._nonStyleParameters}
+        
+        if isinstance(style, str):
+            style = [style]
+        for styleName in style:
+            if isinstance(styleName, dict):
+                styleParameters = styleName
+            else:
+                # seaborn styles were renamed in matplotlib 3.6
+                if styleName not in matplotlib.style.library and styleName.startswith("seaborn"):
+                    styleName = styleName.replace("seaborn", "seaborn-v0_8", 1)
+                styleParameters = matplotlib.style.library[styleName]
+            context.update({parameter : value for parameter, value in styleParameters.items()
+                            if parameter not in Figure._nonStyleParameters})
+        
+        context.update(Figure._getContextSettings())
+        
+        return context
+    
+    def _getContextSettings():
+        settings = {}
 #        seaborn.set_context("poster")
 #        matplotlib.rcParams['figure.figsize'] = list(numpy.asarray(matplotlib.rcParams["figure.figsize"])*2)
 #        if printing: print('figure.figsize', matplotlib.rcParams['figure.figsize'])
 #    
 #        if printing: print('figure.dpi', matplotlib.rcParams['figure.dpi'])
-        matplotlib.rcParams['savefig.dpi'] = 900
+        settings['savefig.dpi'] = 900
 #        if printing: print('savefig.dpi', matplotlib.rcParams['savefig.dpi'])
 #        matplotlib.rcParams['legend.fontsize'] = 14
 #        if printing: print('legend.fontsize', matplotlib.rcParams['legend.fontsize'])
@@ -112,7 +199,7 @@ class Figure:
 #        matplotlib.rcParams['axes.labelsize'] = 42
 #        matplotlib.rcParams['xtick.labelsize'] = 42 #22
 #        matplotlib.rcParams['ytick.labelsize'] = 42 #22
-        matplotlib.rcParams['font.weight']= 'bold' #this should be changed
+        settings['font.weight']= 'bold' #this should be changed
 #        if printing: print('axes.titlesize', matplotlib.rcParams['axes.titlesize'])
 #        if printing: print('axes.labelsize', matplotlib.rcParams['axes.labelsize'])
 #        if printing: print('xtick.labelsize', matplotlib.rcParams['xtick.labelsize'])
@@ -122,16 +209,106 @@ class Figure:
 #        matplotlib.rcParams['text.usetex'] = False
 #        if printing: print("text.latex.unicode", matplotlib.rcParams['text.latex.unicode'])
 #        matplotlib.rcParams['text.latex.preamble']=[r'\usepackage{amsmath}']
-        matplotlib.rc('text', usetex = False)
-        matplotlib.rcParams["lines.markeredgewidth"] = 1.4
+        settings['text.usetex'] = False
+        settings["lines.markeredgewidth"] = 1.4
+        
+        return settings
+    
     def setAdjusting(self, hspace = 0.05, wspace = 0.05, left = None, right = None, top = None, bottom = None):
         self.fig.subplots_adjust( hspace=hspace, wspace = wspace, left = left, right = right, top = top, bottom = bottom)
         
     #, padding = 0.06, bbox_inches = "tight"
-    def save(self, file_extension = ".pdf", useTight = True, close = True):
-            
-        #self.fig.savefig( self.absoluteName.with_suffix( file_extension ), pad_inches = padding, bbox_inches = bbox_inches )
-        self.fig.savefig( self.absoluteName.with_suffix( file_extension ))
+    def save(self, file_extension = ".pdf", useTight = True, close = True,
+             targets = None, preview = False, previewDpi = 100, maxWorkers = None):
+        """
+        targets : list, optional
+            file extensions or (file extension, dpi) pairs written instead of file_extension,
+            e.g. [".pdf", (".png", 300)]. Raster targets are drawn once per distinct dpi
+            and encoded concurrently, vector targets are written one by one.
+        preview : bool
+            also write name_preview.png at previewDpi
+        Every file is name + ending, so dots in name are kept. A file given twice is
+        written once, with different dpis it raises ValueError.
+        Returns the list of written files.
+        """
+        if targets is None:
+            targets = [file_extension]
+        
+        targets = [ target if isinstance(target, tuple) else (target, None) for target in targets ]
+        targets = [ (extension, self._getSaveDpi() if dpi is None else dpi) for extension, dpi in targets ]
+        if preview:
+            targets.append( ("_preview.png", previewDpi) )
+        
+        files = []
+        for ending, dpi in targets:
+            filename = self.getFileName(ending)
+            previous = [ previousDpi for previousFilename, previousDpi in files if previousFilename == filename ]
+            if len(previous) == 0:
+                files.append( (filename, dpi) )
+            elif previous[0] != dpi:
+                raise ValueError(f"Target {filename} is given twice with dpi {previous[0]} and {dpi}")
+        
+        rasterFiles = [ (filename, dpi) for filename, dpi in files if filename.suffix.lower() in Figure._rasterFormats ]
+        vectorFiles = [ (filename, dpi) for filename, dpi in files if filename.suffix.lower() not in Figure._rasterFormats ]
+        
+        for filename, dpi in vectorFiles:
+            #self.fig.savefig( self.absoluteName.with_suffix( file_extension ), pad_inches = padding, bbox_inches = bbox_inches )
+            self.fig.savefig( filename, dpi = dpi)
+        
+        if len(rasterFiles) > 0:
+            self._saveRaster(rasterFiles, maxWorkers)
         
         if close:
-            matplotlib.pyplot.close()
+            self.close()
+        
+        return [ filename for filename, dpi in files ]
+    
+    def getFileName(self, ending):
+        """returns the path of the file name + ending (e.g. ".pdf" or "_preview.png"), dots in name are kept"""
+        return self.absoluteName.parent / (self.absoluteName.name + ending)
+    
+    _rasterFormats = {".png" : "PNG", ".jpg" : "JPEG", ".jpeg" : "JPEG", ".tif" : "TIFF", ".tiff" : "TIFF", ".webp" : "WEBP"}
+    
+    def _saveRaster(self, rasterFiles, maxWorkers = None):
+        images = {}
+        for filename, dpi in rasterFiles:
+            if dpi not in images:
+                images[dpi] = self._renderRGBA(dpi)
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers = maxWorkers) as executor:
+            futures = [ executor.submit(Figure._writeImage, images[dpi], filename, dpi)
+                        for filename, dpi in rasterFiles ]
+            for future in futures:
+                future.result()
+    
+    def _renderRGBA(self, dpi):
+        """draws the figure at dpi on an Agg canvas and returns its RGBA buffer as an image"""
+        originalCanvas = self.fig.canvas
+        originalDpi = self.fig.dpi
+        canvas = matplotlib.backends.backend_agg.FigureCanvasAgg(self.fig)
+        try:
+            self.fig.dpi = dpi
+            canvas.draw()
+            image = PIL.Image.fromarray(numpy.array(canvas.buffer_rgba()))
+        finally:
+            self.fig.dpi = originalDpi
+            self.fig.set_canvas(originalCanvas)
+        
+        return image
+    
+    def _writeImage(image, filename, dpi):
+        imageFormat = Figure._rasterFormats[filename.suffix.lower()]
+        if imageFormat == "JPEG":
+            image = image.convert("RGB")
+        image.save(filename, format = imageFormat, dpi = (dpi, dpi))
+    
+    def _getSaveDpi(self):
+        if self.usePyplot:
+            return matplotlib.rcParams["savefig.dpi"]
+        return self.context["savefig.dpi"]
+    
+    def close(self):
+        if self.usePyplot:
+            matplotlib.pyplot.close(self.fig)
+        else:
+            self.fig.clear()
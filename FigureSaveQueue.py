@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 17:10:37 2026
+
+@author: Jaakko Ahola, Finnish Meteorological Institute
+@licence: MIT licence Copyright
+"""
+import concurrent.futures
+import pickle
+import threading
+
+class FigureSaveQueue:
+    """
+    Saves finished Figure objects in a background thread (or process if useProcesses)
+    so that the data of the next figure can be prepared while the previous one is written, e.g.
+
+        saveQueue = FigureSaveQueue()
+        for ...:
+            fig = Figure(...)
+            ...
+            saveQueue.submit(fig, targets = [".pdf", (".png", 300)])
+        saveQueue.wait()
+
+    At most maxQueued figures are waiting or being saved, submit blocks until there is room.
+    Errors of the saves are raised by flush / wait.
+    """
+
+    def __init__(self, maxQueued = 2, maxWorkers = 1, useProcesses = False):
+        if useProcesses:
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers = maxWorkers)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = maxWorkers)
+
+        self.useProcesses = useProcesses
+        self.slots = threading.BoundedSemaphore(maxQueued)
+        self.lock = threading.Lock()
+        self.futures = []
+
+    def submit(self, figure, **saveArguments):
+        """
+        Hands figure to the writer and closes it, saveArguments are passed to Figure.save.
+        Returns a Future of the list of written files.
+        """
+        saveArguments["close"] = False
+        self.slots.acquire()
+        try:
+            if self.useProcesses:
+                future = self.executor.submit(FigureSaveQueue._savePickled, pickle.dumps(figure), saveArguments)
+                figure.close()
+            else:
+                if figure.usePyplot:
+                    # only removes the figure from pyplot, it can still be drawn
+                    figure.close()
+                future = self.executor.submit(FigureSaveQueue._save, figure, saveArguments)
+        except BaseException:
+            self.slots.release()
+            raise
+
+        with self.lock:
+            self.futures.append(future)
+        future.add_done_callback(self._done)
+
+        return future
+
+    def flush(self):
+        """waits until the submitted figures are saved and raises the errors of the failed saves"""
+        with self.lock:
+            futures = self.futures
+            self.futures = []
+
+        concurrent.futures.wait(futures)
+
+        # read from the futures, the done callbacks may run after wait has returned
+        errors = [future.exception() for future in futures if future.exception() is not None]
+
+        if len(errors) > 0:
+            raise RuntimeError(f"Saving {len(errors)} figure(s) failed: {errors}") from errors[0]
+
+    def wait(self):
+        """flushes the queue and stops the writer"""
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown(wait = True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.wait()
+        else:
+            self.executor.shutdown(wait = True)
+
+    def _done(self, future):
+        self.slots.release()
+
+    def _save(figure, saveArguments):
+        return figure.save(**saveArguments)
+
+    def _savePickled(pickledFigure, saveArguments):
+        return FigureSaveQueue._save(pickle.loads(pickledFigure), saveArguments)
@@ -6,10 +6,19 @@ Created on Fri Jan 10 13:22:16 2020
 @author: Jaakko Ahola, Finnish Meteorological Institute
 @licence: MIT licence Copyright
 """
+import atexit
+import json
+import os
 import pathlib
+import threading
 import yaml
 
 class FileSystem:
+    
+    _ncFileIndexCache = {}
+    _ncFileIndexCacheFile = None
+    _ncFileIndexLock = threading.Lock()
+    
     def createSubfolder(rootfolderName, subfolderName):
         subfolder = pathlib.Path(rootfolderName) / subfolderName
         subfolder.mkdir( parents=True, exist_ok = True )
@@ -55,3 +64,93 @@ class FileSystem:
             yield key
             if isinstance(value, dict):
                 yield from FileSystem.get_all_keys_from_dict(value)
+
+    def getNCFileIndex(folder):
+        """
+        Parameters
+        ----------
+        folder : str or pathlib.Path
+
+
+        Returns the .nc files of folder classified by kind as a dictionary
+        {"main" : [...], "ps" : [...], "ts" : [...], "aux" : [...]} of filenames.
+        The directory is listed only when its modification time has changed since
+        the previous call, otherwise the index is served from a cache that is
+        shared by all callers (and stored on disk if setNCFileIndexCacheFile is used).
+
+        """
+        folder = pathlib.Path(folder).absolute()
+        key = str(folder)
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+        except FileNotFoundError:
+            return FileSystem._classifyNCFiles([])
+
+        with FileSystem._ncFileIndexLock:
+            cached = FileSystem._ncFileIndexCache.get(key)
+            if cached is not None and cached["mtime"] == mtime:
+                return cached["index"]
+
+        with os.scandir(folder) as entries:
+            fileNames = [entry.name for entry in entries if entry.name.endswith(".nc") and entry.is_file()]
+        index = FileSystem._classifyNCFiles(fileNames)
+
+        with FileSystem._ncFileIndexLock:
+            FileSystem._ncFileIndexCache[key] = {"mtime" : mtime, "index" : index}
+
+        return index
+
+    def getNCFile(folder, kind):
+        """
+        Returns the absolute path of the first .nc file of kind "main", "ps", "ts" or "aux" in folder or None
+        """
+        fileNames = FileSystem.getNCFileIndex(folder)[kind]
+        if len(fileNames) == 0:
+            return None
+
+        return pathlib.Path(folder) / fileNames[0]
+
+    def _classifyNCFiles(fileNames):
+        index = {"main" : [], "ps" : [], "ts" : [], "aux" : []}
+        for fileName in sorted(fileNames):
+            suffixes = pathlib.PurePath(fileName).suffixes
+            if ".ps" in suffixes:
+                index["ps"].append(fileName)
+            elif ".ts" in suffixes:
+                index["ts"].append(fileName)
+            elif len(suffixes) == 1:
+                index["main"].append(fileName)
+            else:
+                index["aux"].append(fileName)
+
+        return index
+
+    def setNCFileIndexCacheFile(cacheFile):
+        """
+        Stores the .nc file index cache to cacheFile (JSON). Existing entries
+        are loaded immediately and the cache is written back at exit or with
+        saveNCFileIndexCache.
+        """
+        cacheFile = pathlib.Path(cacheFile)
+        with FileSystem._ncFileIndexLock:
+            if cacheFile.exists():
+                with open(cacheFile, "r") as stream:
+                    try:
+                        FileSystem._ncFileIndexCache.update(json.load(stream))
+                    except json.JSONDecodeError as exc:
+                        print(exc)
+            if FileSystem._ncFileIndexCacheFile is None:
+                atexit.register(FileSystem.saveNCFileIndexCache)
+            FileSystem._ncFileIndexCacheFile = cacheFile
+
+    def saveNCFileIndexCache():
+        if FileSystem._ncFileIndexCacheFile is None:
+            return
+        with FileSystem._ncFileIndexLock:
+            FileSystem._ncFileIndexCacheFile.parent.mkdir( parents=True, exist_ok = True )
+            with open(FileSystem._ncFileIndexCacheFile, "w") as stream:
+                json.dump(FileSystem._ncFileIndexCache, stream)
+
+    def clearNCFileIndexCache():
+        with FileSystem._ncFileIndexLock:
+            FileSystem._ncFileIndexCache.clear()
@@ -6,10 +6,12 @@ Created on Mon Jan 20 12:28:17 2020
 @author: Jaakko Ahola, Finnish Meteorological Institute
 @licence: MIT licence Copyright
 """
+import concurrent.futures
 import numpy
 import pandas
 import pathlib
 import sys
+import time
 
 from FileSystem import FileSystem
 from Simulation import Simulation
@@ -73,7 +75,7 @@ class InputSimulation:
         
         return self.simulationDataFrame
     
-    def getSimulationCollection(simulationDataFrame): #public
+    def getSimulationCollection(simulationDataFrame, chunks = None): #public
         simulationCollection = {}
         
         if not ( simulationDataFrame.index.name == "ID"):
@@ -84,9 +86,74 @@ class InputSimulation:
         for ind in simulationDataFrame.index:
             simulationCollection[ ind ] = Simulation( simulationDataFrame.loc[ind]["FOLDER"],
                                                                                     simulationDataFrame.loc[ind]["LABEL"],
-                                                                                    simulationDataFrame.loc[ind]["COLOR"])
+                                                                                    simulationDataFrame.loc[ind]["COLOR"],
+                                                                                    chunks = chunks,
+                                                                                    simulationID = ind)
         return simulationCollection
 
+    def prefetchSimulationCollection(simulationCollection : dict,
+                                     kinds = ("ts",),
+                                     auxFiles = None,
+                                     maxWorkers = None,
+                                     useProcesses = False): #public
+        """
+        Opens the dataset kinds ("nc", "ps", "ts", "aux") of all simulations of
+        simulationCollection on a thread pool (or a process pool if useProcesses)
+        and stores them to the Simulation objects.
+        
+        auxFiles : dict of AUX key -> filename relative to the simulation folder, used with kind "aux"
+        
+        Returns a DataFrame indexed by ID with the time used per simulation (SECONDS)
+        and the error message (ERROR) of the simulations that failed. Failing
+        simulations are reported, not exited on.
+        """
+        if auxFiles is None:
+            auxFiles = {}
+        
+        if useProcesses:
+            executorClass = concurrent.futures.ProcessPoolExecutor
+        else:
+            executorClass = concurrent.futures.ThreadPoolExecutor
+        
+        report = pandas.DataFrame(index = pandas.Index(list(simulationCollection), name = "ID"),
+                                  columns = ["SECONDS", "ERROR"], dtype = object)
+        
+        with executorClass(max_workers = maxWorkers) as executor:
+            futures = { executor.submit( InputSimulation._prefetchSimulation,
+                                         simulation, kinds, auxFiles ) : ind
+                        for ind, simulation in simulationCollection.items() }
+            
+            for future in concurrent.futures.as_completed(futures):
+                ind = futures[future]
+                try:
+                    datasets, seconds, error = future.result()
+                except Exception as exc:
+                    datasets, seconds, error = {}, numpy.nan, repr(exc)
+                
+                for (kind, key), dataset in datasets.items():
+                    simulationCollection[ind].setDataset(kind, dataset, key)
+                
+                report.loc[ind, "SECONDS"] = seconds
+                report.loc[ind, "ERROR"] = error
+        
+        return report
+    
+    def _prefetchSimulation(simulation, kinds, auxFiles):
+        start = time.time()
+        datasets = {}
+        error = None
+        try:
+            for kind in kinds:
+                if kind == "aux":
+                    for key, filename in auxFiles.items():
+                        datasets[(kind, key)] = simulation.openDataset(kind, filename)
+                else:
+                    datasets[(kind, None)] = simulation.openDataset(kind)
+        except Exception as exc:
+            error = repr(exc)
+        
+        return datasets, time.time() - start, error
+    
     def getSimulationDataFrame(self):
         return self.simulationDataFrame
 
@@ -6,11 +6,21 @@ Created on Fri Jan 10 13:17:52 2020
 @author: Jaakko Ahola, Finnish Meteorological Institute
 @licence: MIT licence Copyright
 """
+import collections
+import concurrent.futures
 import matplotlib
+import matplotlib.artist
+import matplotlib.backends.backend_agg
+import matplotlib.collections
+import matplotlib.colors
 import numpy
 import os
 import pathlib
+import PIL.Image
 import seaborn
+import shutil
+import subprocess
+import xarray
 
 from Data import Data
 from FileSystem import FileSystem
@@ -22,6 +32,8 @@ from decimal import Decimal
 
 class Plot:
     
+    _animationDatasets = {}
+    
     def getVerticalLine(ax, x, color = 'k', linestyle = '--' ):
         ax.axvline( x, color = color , linestyle = linestyle )
 
@@ -33,22 +45,34 @@ class Plot:
     def getTimeseries(ax,
                       simulation : Simulation,
                       muuttuja,
-                      conversionFactor = 1.0):
+                      conversionFactor = 1.0,
+                      store = None,
+                      storeTimeUnit = "h",
+                      decimate = False,
+                      rasterized = False,
+                      pixels = None):
+        """
+        store : TimeseriesStore, optional
+            if given, the data is read from the store by simulation.getID()
+            instead of the TS dataset of the simulation, with time in storeTimeUnit
+        decimate : bool
+            with a list of simulations, draw all of them as one LineCollection with each
+            series reduced to the first, last, minimum and maximum point per pixel column
+            of ax (pixels, default: axes width at savefig.dpi)
+        rasterized : bool
+            rasterize the LineCollection in vector outputs
+        """
         if isinstance(simulation, list):
+            if decimate:
+                return Plot._getTimeseriesCollection(ax, simulation, muuttuja, conversionFactor,
+                                                     store, storeTimeUnit, rasterized, pixels)
             for simulationInstance in simulation:
-                ax = Plot.getTimeseries(ax, simulationInstance, muuttuja, conversionFactor)
+                ax = Plot.getTimeseries(ax, simulationInstance, muuttuja, conversionFactor, store, storeTimeUnit)
             return ax
-        try:
-            ts = simulation.getTSDataset()
-        except FileNotFoundError:
-            print("FileNotFoundError: Data from {0} not found in {1}. \
-                  Continue with existing data".format(simulation.getLabel(), simulation.getFolder()))
+        
+        dataset = Plot._getTimeseriesData(simulation, muuttuja, store, storeTimeUnit)
+        if dataset is None:
             return ax
-        try:
-            dataset = ts[muuttuja]
-        except KeyError:
-            print("KeyError", simulation.getLabel(), simulation.getFolder())
-            return None
         
         # conversion
         dataset = dataset*conversionFactor
@@ -61,6 +85,100 @@ class Plot:
         
         return ax
     
+    def _getTimeseriesData(simulation : Simulation, muuttuja, store = None, storeTimeUnit = "h"):
+        if store is not None:
+            try:
+                dataset = store.getDataArray(simulation.getID(), muuttuja, storeTimeUnit)
+            except KeyError:
+                print("KeyError", simulation.getLabel(), simulation.getID(), "TimeseriesStore")
+                return None
+        else:
+            try:
+                ts = simulation.getTSDataset()
+            except FileNotFoundError:
+                print("FileNotFoundError: Data from {0} not found in {1}. \
+                      Continue with existing data".format(simulation.getLabel(), simulation.getFolder()))
+                return None
+            try:
+                dataset = ts[muuttuja]
+            except KeyError:
+                print("KeyError", simulation.getLabel(), simulation.getFolder())
+                return None
+        
+        return dataset
+    
+    def _getTimeseriesCollection(ax, simulationList, muuttuja, conversionFactor,
+                                 store, storeTimeUnit, rasterized, pixels):
+        series = []
+        for simulation in simulationList:
+            dataset = Plot._getTimeseriesData(simulation, muuttuja, store, storeTimeUnit)
+            if dataset is not None:
+                series.append( (simulation, dataset["time"].values, dataset.values*conversionFactor) )
+        
+        if len(series) == 0:
+            return ax
+        
+        if pixels is None:
+            pixels = Plot._getAxesPixels(ax)[0]
+        
+        xmin = min(numpy.nanmin(time) for simulation, time, values in series)
+        xmax = max(numpy.nanmax(time) for simulation, time, values in series)
+        
+        segments = []
+        for simulation, time, values in series:
+            indexes = Data.getDecimatedIndexes(time, values, pixels, xmin, xmax)
+            segments.append(numpy.column_stack((time[indexes], values[indexes])))
+        
+        linewidths = [ simulation.getLineWidth() if simulation.getLineWidth() is not None else matplotlib.rcParams["lines.linewidth"]
+                       for simulation, time, values in series ]
+        
+        collection = matplotlib.collections.LineCollection(segments,
+                                                           colors = [simulation.getColor() for simulation, time, values in series],
+                                                           linewidths = linewidths,
+                                                           zorder = max(simulation.getZorder() for simulation, time, values in series),
+                                                           rasterized = rasterized)
+        ax.add_collection(collection)
+        ax.autoscale_view()
+        
+        # empty lines as legend handles
+        for ind, (simulation, time, values) in enumerate(series):
+            ax.plot([], [], color = simulation.getColor(), label = simulation.getLabel(), linewidth = linewidths[ind])
+        
+        ax.set_xlabel("time")
+        ax.set_ylabel(muuttuja)
+        
+        return ax
+    
+    def getTimeseriesConfidenceBand(ax,
+                                    statistics,
+                                    confidence = 0.95,
+                                    color = "black",
+                                    label = None,
+                                    alpha = 0.3,
+                                    timeUnit = "h",
+                                    linewidth = None,
+                                    zorder = 1):
+        """
+        statistics : EnsembleStatistics
+            draws the ensemble mean and its confidence band at confidence
+        """
+        time = statistics.getTime(timeUnit)
+        low, high = statistics.getConfidenceBand(confidence)
+        
+        ax.fill_between(time, low, high, color = color, alpha = alpha, linewidth = 0, zorder = zorder)
+        ax.plot(time, statistics.getMean(), color = color, label = label, linewidth = linewidth, zorder = zorder)
+        
+        return ax
+    
+    def _getAxesPixels(ax):
+        """returns the (width, height) of ax in pixels at savefig.dpi"""
+        savefigDpi = matplotlib.rcParams["savefig.dpi"]
+        if savefigDpi == "figure":
+            savefigDpi = ax.figure.dpi
+        scale = savefigDpi / ax.figure.dpi
+        
+        return int(numpy.ceil(ax.bbox.width * scale)), int(numpy.ceil(ax.bbox.height * scale))
+    
     #REVISEu
     def getTimeseriesOfProfile(ax,
                          simulation : Simulation,
@@ -68,8 +186,17 @@ class Plot:
                          levels = None,
                          useLogaritmic = False,
                          useColorBar = False,
-                         colors = None):
-
+                         colors = None,
+                         useRaster = False,
+                         pixels = None,
+                         cmap = None):
+        """
+        useRaster : bool
+            instead of contourf, average the field to the pixel grid of ax
+            (pixels = (width, height), default: axes size at savefig.dpi)
+            and draw it with a rasterized pcolormesh. With useLogaritmic the
+            log scale is applied with a LogNorm.
+        """
         ps = simulation.getPSDataset()
         
         try:
@@ -78,41 +205,84 @@ class Plot:
             print("KeyError", simulation, muuttuja, "Plot.getTimeseriesOfProfile")            
             return
         
+        if useLogaritmic and levels is None:
+            levels, rangePotenssi, minimiPotenssi, maksimiPotenssi = Data.getLogScale(data.values)
+            levels = rangePotenssi
+        
+        if useRaster:
+            im = Plot._getProfileRaster(ax, data, levels, useLogaritmic, useColorBar, colors, pixels, cmap)
+            return ax, im, levels
+        
         if useLogaritmic:
-            if levels is None:
-                levels, rangePotenssi, minimiPotenssi, maksimiPotenssi = Data.getLogScale(data.values)
-                levels = rangePotenssi
+            data = numpy.log10(data)
             
-            data.values  = numpy.log10(data.values)
-            
-        im = data.plot.contourf("time","zt", ax = ax, levels=levels, add_colorbar = useColorBar, colors = colors) #
+        im = data.plot.contourf("time","zt", ax = ax, levels=levels, add_colorbar = useColorBar, colors = colors, cmap = cmap) #
         
         return ax, im, levels
     
+    def _getProfileRaster(ax, data, levels, useLogaritmic, useColorBar, colors, pixels, cmap):
+        if pixels is None:
+            pixels = Plot._getAxesPixels(ax)
+        
+        factors = {"time" : max(1, data.sizes["time"] // max(1, pixels[0])),
+                   "zt" : max(1, data.sizes["zt"] // max(1, pixels[1]))}
+        factors = {dim : factor for dim, factor in factors.items() if factor > 1}
+        if len(factors) > 0:
+            data = data.coarsen(factors, boundary = "pad").mean()
+        
+        if useLogaritmic:
+            norm = matplotlib.colors.LogNorm(vmin = 10.**levels[0], vmax = 10.**levels[-1])
+            levels = None
+        else:
+            norm = None
+        
+        im = data.plot.pcolormesh(x = "time", y = "zt", ax = ax, levels = levels, norm = norm,
+                                  add_colorbar = useColorBar, colors = colors, cmap = cmap,
+                                  rasterized = True)
+        
+        return im
+    
     def getContourLine(ax,
                        simulation : Simulation,
                        muuttuja,
                        value,
                        color = "black",
-                       epsilon = 1e-12):
-        ps = simulation.getPSDataset()
+                       epsilon = 1e-12,
+                       linewidth = None,
+                       timeUnit = None):
+        """
+        Draws the isoline of muuttuja at value from simulation.getIsolines, which traces it
+        once per simulation so the same contour can be drawn on many axes.
+        timeUnit defaults to the unit of the time coordinate of the ps dataset.
+        epsilon is not used anymore and is kept for compatibility.
+        """
+        if timeUnit is None:
+            timeUnit = simulation.getTimeUnit("ps")
+        
         try:
-            data = ps[muuttuja]
+            isolines = simulation.getIsolines(muuttuja, value, timeUnit)
         except KeyError:
             print("KeyError", simulation, muuttuja, "Plot.getContourLine")
             return
         
-        data.plot.contour(x="time", y="zt",ax=ax, colors = color, vmin = value - epsilon , vmax = value + epsilon)
+        collection = matplotlib.collections.LineCollection(isolines, colors = color, linewidths = linewidth)
+        ax.add_collection(collection)
+        ax.autoscale_view()
         
         return ax
     
     def getColorBar(im, ax, levels = None):
-        cb = matplotlib.pyplot.colorbar(im, cax = ax, ticks = levels, orientation='horizontal') #, pad=0.21
+        ticks = levels
+        if levels is not None and isinstance(im.norm, matplotlib.colors.LogNorm):
+            ticks = numpy.power(10., levels)
+        cb = ax.figure.colorbar(im, cax = ax, ticks = ticks, orientation='horizontal') #, pad=0.21
         if levels is not None:
             cb.ax.set_xticklabels([r"$10^{" + str(int(elem)) + "}$" for elem in levels]) 
             
             colorbarLabelListShowBoolean = Data.getIntegerExponentsAsBoolean( levels )
-            cb = PlotTweak.hideColorbarXLabels(cb, colorbarLabelListShowBoolean)
+            PlotTweak.hideLabels(cb.ax.xaxis, colorbarLabelListShowBoolean)
+        
+        return cb
     
     # REVISE
     def getTimeseriesOfProportions(axes,
@@ -124,7 +294,8 @@ class Plot:
                                    figurePrefix = "",
                                    kuvakansio = "/home/aholaj/OneDrive/000_WORK/000_ARTIKKELIT/000-Manuscript-ICE/kuvat/bini/",
                                    kuvakansioPDF = "/home/aholaj/OneDrive/000_WORK/000_ARTIKKELIT/000-Manuscript-ICE/figures_pdf",
-                                   filenamePDF = "figure6"):
+                                   filenamePDF = "figure6",
+                                   linewidth = 6):
         
         print(mode, end = " ")
         if height is not None:
@@ -133,63 +304,18 @@ class Plot:
             print()
         
         
-        ps = simulation.getPSDataset()
-        if ps is None:
-            return "FileNotFound"
-        
-        ts = simulation.getTSDataset()
-        if ts is None:
-            return "FileNotFound"
-        
-        timeStartInd = Data.getClosestIndex( ps.time.values, timeStartH*3600 )
-        timeEndInd   = Data.getClosestIndex( ps.time.values, timeEndH*3600 )
-        ps = ps.isel(time = slice(timeStartInd,timeEndInd))
-        
-        
         try:
-        
-            if mode == "inCloud":
-               # ps = ps.sel(zt = slice(665,745)).mean(dim = "zt")
-                ps = ps.where( (ps.P_rl > limit) & (ps.P_ri > limit), drop = True).mean(dim = "zt", skipna = True) #ps.where(ps.zt > ts.zb).where(ps.zt < ts.zc).mean(dim = "zt")#
-            elif mode == "belowCloud":
-                #ps = ps.sel(zt = slice(5,410)).mean(dim = "zt")
-                ps = ps.where(ps.P_rl < limit, drop = True).where(ps.zt < ts.zb, drop = True).mean(dim = "zt", skipna = True) #.where(ps.P_rl < 1e-6, drop = True)
-            elif mode == "aboveCloud":
-                ps = ps.where(ps.zt > ts.zc, drop = True).mean(dim = "zt", skipna = True) #.where(ps.P_rl < 1e-6, drop = True)
-            elif mode == "height":
-                ps = ps.sel(zt = height, method = 'nearest')        
+            proportions = simulation.getBinProportions(mode, limit, height, packing, timeStartH, timeEndH)
         except KeyError:
             return
         
-        ps = ps.assign_coords(time = (ps.time / 3600))
+        binNumber = proportions.sizes["dryRadiusBinB"]
         
-                
-        try:
-            aero  = ps["P_Nabb"]
-            cloud = ps["P_Ncbb"]
-            ice   = ps["P_Nibb"]
-        except KeyError:
-            return
         
-        newname = "dryRadiusBinB"
-        aero = aero.rename({"aeb":newname})
-        cloud = cloud.rename({"clb":newname})
-        ice   = ice.rename({"icb":newname})
-        
-        total = aero + cloud + ice
-        
-        if packing is not None:
-            for daatta in aero, cloud, ice, total:
-                daatta[:,packing] = numpy.sum(daatta[:,packing:], axis = 1)
-        
-        binNumber = min( numpy.shape(total.values)[1], packing +1 )
-        
-        
-        matplotlib.rcParams['lines.linewidth'] = 6
         yTicks = [0, 0.5, 1]
         yTickLabels = map(str, yTicks)
             
-        matplotlib.pyplot.subplots_adjust(hspace=0.05, wspace = 0.05)
+        axes[0].figure.subplots_adjust(hspace=0.05, wspace = 0.05)
             
         xLabelListShow = numpy.arange(8, 48+1, 8)
         xLabelListShow = numpy.insert(xLabelListShow, 0, 2)
@@ -199,28 +325,20 @@ class Plot:
         
         for bini in range(binNumber):
             ax = axes[bini]
-            aeroBin = aero[:,bini]
-            cloudBin = cloud[:,bini]
-            iceBin  = ice[:,bini]
-            
-            totalBin = total[:,bini]
+            binProportions = proportions.isel(dryRadiusBinB = bini)
             
-            aeroFrac = aeroBin/totalBin
-            cloudFrac = cloudBin/totalBin
-            iceFrac = iceBin/totalBin
+            totalBin = binProportions["total"]
             
-            totalBinRelative  = totalBin / totalBin.values[0]
-            
-            aeroFrac.plot(ax=ax, color = "#e6194B")
-            cloudFrac.plot(ax=ax, color = "#000075")
-            iceFrac.plot(ax=ax, color = "#42d4f4")
-            totalBinRelative.plot(ax = ax, color = "black")
+            binProportions["fraction"].sel(species = "aerosol").plot(ax=ax, color = "#e6194B", linewidth = linewidth)
+            binProportions["fraction"].sel(species = "cloud").plot(ax=ax, color = "#000075", linewidth = linewidth)
+            binProportions["fraction"].sel(species = "ice").plot(ax=ax, color = "#42d4f4", linewidth = linewidth)
+            binProportions["totalRelative"].plot(ax = ax, color = "black", linewidth = linewidth)
             
             ax.set_yticks( yTicks )
             ax.set_yticklabels( yTickLabels )
             ax.set_ylim( 0, 1.5)
             ax.set_title("")
-            matplotlib.pyplot.setp(ax.get_yticklabels()[1], visible=False)
+            matplotlib.artist.setp(ax.get_yticklabels()[1], visible=False)
             
             if packing is not None and bini == (binNumber - 1):
                 bininame = str(bini + 1 ) + " - 7"
@@ -248,7 +366,7 @@ class Plot:
             else:
                 setXlabel =False
             
-            ax = PlotTweak.setXTicksLabelsAsTime(ax, ps.time.values, xLabelListShow = xLabelListShow, xLabelListMajorLine = xLabelListMajorLine, setXlabel = setXlabel)
+            ax = PlotTweak.setXTicksLabelsAsTime(ax, proportions.time.values, xLabelListShow = xLabelListShow, xLabelListMajorLine = xLabelListMajorLine, setXlabel = setXlabel)
             
             if bini in [0,1]:
                 ax.set_xticklabels([])
@@ -274,7 +392,8 @@ class Plot:
         
         zt = ps.zt
         
-        psSliced = ps.sel(zt = height, method = "nearest").isel(time = slice(61,1440))
+        timeSlice = slice(61,1440)
+        psSliced = ps.sel(zt = height, method = "nearest").isel(time = timeSlice)
         try:
             data = psSliced[muuttuja]
         except KeyError:
@@ -309,11 +428,9 @@ class Plot:
         ################################            
                 
         dataAllBins = data
-        dataAllBins = dataAllBins.assign_coords(time = (dataAllBins.time / 3600))
+        dataAllBins = dataAllBins.assign_coords(time = simulation.getTimeCoordinate("ps", "h")[timeSlice])
         size = numpy.shape(dataAllBins.values)[1]
         colorpalette = seaborn.color_palette(cmap, 10)
-        skip = 0
-        aero = None
         includeOtherAero = False
         includeParallelOthercloud = False
         includeParallelCloud = True
@@ -321,58 +438,51 @@ class Plot:
         label = biniTieto + " bin |" + r"$N_0\ (\#/kg)$"
         
         legend_elements = [matplotlib.patches.Patch(facecolor="white",label=label)]
-        for bini in range(size):
-            plottable = dataAllBins[:,bini]
-            
-            vertailuData = numpy.zeros( numpy.shape(plottable.values))
-            
-            if Data.isCloseToEpsilon(plottable, limiter):
-                skip += 1
-                continue
-            
-            if AerosolAbins:
-                parallelBaeroBini  = bini - 3
-                parallelAcloudBini = bini - 3
-                parallelBcloudBini = bini - 3
-    
-            elif AerosolBbins:
-                parallelAaeroBini = bini + 3
-                parallelAcloudBini = bini
-                parallelBcloudBini = bini
+        
+        vertailuData = numpy.zeros( numpy.shape(dataAllBins.values) )
+        binit = numpy.arange(size)
+        
+        if AerosolAbins:
+            parallelBaeroBini  = binit - 3
+            parallelAcloudBini = binit - 3
+            parallelBcloudBini = binit - 3
+        
+        elif AerosolBbins:
+            parallelAaeroBini = binit + 3
+            parallelAcloudBini = binit
+            parallelBcloudBini = binit
+        
+        # negative parallel bin indexes count from the end as in indexing a single bin
+        if aerosolsUsed:# and (parallelbini >= 0):
             
+            if includeOtherAero:
+                if AerosolAbins:
+                    vertailuData = vertailuData + numpy.where(parallelBaeroBini > 0, parallelAeroB.values[:, parallelBaeroBini], 0.)
+                elif AerosolBbins:
+                    vertailuData = vertailuData + parallelAeroA.values[:, parallelAaeroBini]
             
-            if aerosolsUsed:# and (parallelbini >= 0):
-                
-                if includeOtherAero:
-                    if AerosolAbins and parallelBaeroBini > 0:
-                        aero = parallelAeroB[:, parallelBaeroBini]
-                    elif AerosolBbins:
-                        aero = parallelAeroA[:, parallelAaeroBini]
-                    
-                    vertailuData = vertailuData + aero.values
-                
-                if includeParallelOthercloud:
-                    if AerosolAbins and parallelBcloudBini>0:
-                        parallelOtherCloud = parallelCloudB[:, parallelBcloudBini ]
-                    
-                    elif AerosolBbins and parallelAcloudBini>0:
-                        parallelOtherCloud = parallelCloudA[:, parallelAcloudBini ]
-                    
-                    vertailuData = vertailuData + parallelOtherCloud.values
-                
-                
-                if includeParallelCloud:
-                    if AerosolAbins:
-                        parallelCloud = parallelCloudA[:, parallelAcloudBini]
-                    elif AerosolBbins:
-                        parallelCloud = parallelCloudB[:, parallelBcloudBini]
-                    
-                    vertailuData = vertailuData + parallelCloud.values
-                
-                
-            denom = plottable.values + vertailuData
-            plottable, lahtoarvo = Data.getRelativeChange(plottable, denominator=denom, limiter = limiter)
+            if includeParallelOthercloud:
+                if AerosolAbins:
+                    vertailuData = vertailuData + numpy.where(parallelBcloudBini > 0, parallelCloudB.values[:, parallelBcloudBini], 0.)
+                elif AerosolBbins:
+                    vertailuData = vertailuData + numpy.where(parallelAcloudBini > 0, parallelCloudA.values[:, parallelAcloudBini], 0.)
             
+            if includeParallelCloud:
+                if AerosolAbins:
+                    vertailuData = vertailuData + parallelCloudA.values[:, parallelAcloudBini]
+                elif AerosolBbins:
+                    vertailuData = vertailuData + parallelCloudB.values[:, parallelBcloudBini]
+        
+        denom = dataAllBins.values + vertailuData
+        
+        activeBins = numpy.flatnonzero( ~Data.isCloseToEpsilonColumns(dataAllBins.values, limiter) )
+        skip = size - activeBins.shape[0]
+        
+        relativeAllBins, lahtoarvot = Data.getRelativeChanges(dataAllBins[:, activeBins], denominator = denom[:, activeBins], limiter = limiter)
+        
+        for ind, bini in enumerate(activeBins):
+            plottable = relativeAllBins[:, ind]
+            lahtoarvo = lahtoarvot[ind]
             
             color = Data.getColorBin(colorpalette, bini, plottable)
             plottable.plot(ax=ax, color = color)
@@ -384,7 +494,7 @@ class Plot:
             legend_elements.append(matplotlib.patches.Patch(facecolor=color,label=label))
     
         if skip == size:
-            matplotlib.pyplot.close()
+            matplotlib.pyplot.close(ax.figure)
             return None
         
         #matplotlib.pyplot.axvline( 2, color = "k" , linestyle = "--" )
@@ -393,7 +503,7 @@ class Plot:
         ax.legend(handles=legend_elements, loc='best', frameon = True, framealpha = 1.0 )
         
         heightTosi = str(int(zt.sel(zt = height, method = 'nearest' ).values))
-        matplotlib.pyplot.title("zt =" + heightTosi + "(m)" )
+        ax.set_title("zt =" + heightTosi + "(m)" )
     #    print(time.values)
         ax = PlotTweak.setXTicksLabelsAsTime(ax, plottable["time"].values, startPoint=8)
     
@@ -410,16 +520,8 @@ class Plot:
                                                color = "b",
                                                height =745, timeH = 2.5):
         
-        ps = simulation.getPSDataset()
-
-        
-        if ps is None:
-            return "FileNotFound"
-        
-        ps = ps.sel(zt=height).sel(time=timeH*3600, method = "nearest")
-        
         try:
-            dataarray = ps[muuttuja]
+            dataarray = simulation.getSizeDistributionPoints(muuttuja, height, timeH)[muuttuja].isel(point = 0)
         except KeyError:
             return
         
@@ -428,55 +530,211 @@ class Plot:
         
         dataarray.plot.line(ax=ax, color = color , marker="o", label=label) #aero "#e6194B" cloud  "#000075" ice "#42d4f4"
         
-        matplotlib.pyplot.legend()
+        ax.legend()
+        ax.set_yscale("log")
+        ax.set_xscale("log")
+        
+        return ax
+    
+    def getSizeDistributions(ax,
+                             simulation : Simulation,
+                             muuttuja,
+                             heights, timesH,
+                             labels = None,
+                             colors = None,
+                             marker = "o"):
+        """
+        Draws the size distributions of muuttuja at the points (heights[i], timesH[i])
+        on log-log axes with one plot call, see Simulation.getSizeDistributionPoints.
+        """
+        try:
+            dataarray = simulation.getSizeDistributionPoints(muuttuja, heights, timesH)[muuttuja]
+        except KeyError:
+            return
+        
+        binDim = [dim for dim in dataarray.dims if dim != "point"][0]
+        
+        lines = ax.plot(dataarray[binDim].values, dataarray.transpose(binDim, "point").values, marker = marker)
+        
+        for ind, line in enumerate(lines):
+            if colors is not None:
+                line.set_color(colors[ind])
+            if labels is not None:
+                line.set_label(labels[ind])
+        
         ax.set_yscale("log")
         ax.set_xscale("log")
         
         return ax
 
 
-    ### getAnimation2D NEEDS REVISION ####
     def getAnimation2D(ax,
                        simulation : Simulation,
                        muuttuja = "S_Nc",
                        kuvakansio =  "/home/aholaj/OneDrive/000_WORK/000_ARTIKKELIT/000-Manuscript-ICE/kuvat/anim",
-                       useAverage=False, ytValue = 0, useLog = False):
-        
-        nc = simulation.getNCDataset()
-
-        if nc is None:
+                       useAverage=False, ytValue = 0, useLog = False,
+                       timeStartH = 2.5, timeEndH = 49,
+                       fileName = "animation.gif",
+                       vmin = None, vmax = None,
+                       cmap = "Blues_r",
+                       frameDuration = 500,
+                       figsize = None, dpi = 100,
+                       maxWorkers = None):
+        """
+        Renders an xt-zt animation of the NC variable muuttuja to kuvakansio/muuttuja/fileName (.gif or .mp4).
+        
+        Each frame reads only its own time step from the NetCDF file and the frames
+        are rendered on a process pool with at most two frames per worker in flight.
+        The colour normalisation is fixed for all frames: vmin and vmax are computed
+        with a streaming pass over the frames if not given. The GIF is encoded with
+        Pillow from palette frames, MP4 frames are piped to ffmpeg
+        (rcParams["animation.ffmpeg_path"]) as they complete and a RuntimeError
+        with the ffmpeg error output is raised if it fails.
+        Limitation: the GIF palette frames (one byte per pixel) are kept in memory
+        until the end, use .mp4 for long or large animations.
+        frameDuration is in milliseconds. Returns the path of the animation.
+        """
+        fileNameNC = simulation.getNCDatasetFileName()
+        
+        if fileNameNC is None:
             return "FileNotFound"
-    
-        try:
-            dataAnim = nc[muuttuja]#.sel(zt = slice(395, 850))    
-        except KeyError:
+        
+        if muuttuja not in simulation.getNCDataset():
             return
         
-        dataAnim = dataAnim.assign_coords(time = (dataAnim.time / 3600))
         print(" ")
         print("animate", muuttuja)
-        if useLog:
-            dataAnim.values = numpy.ma.log10(dataAnim.values).filled(0)
         
-        if useAverage:
-            dataAnim = dataAnim.mean(dim="yt")
-            
-        else:
-            dataAnim = dataAnim.sel(yt = ytValue, method="nearest")
-        dataAnim= dataAnim.sel(time = slice(2.5,49))
-        timeSpan = numpy.shape(dataAnim)[0]
+        timeH = simulation.getTimeCoordinate("nc", "h").values
+        frames = numpy.arange( numpy.searchsorted(timeH, timeStartH, side = "left"),
+                               numpy.searchsorted(timeH, timeEndH, side = "right") )
+        if len(frames) == 0:
+            return
+        
+        fieldArguments = [str(fileNameNC), muuttuja, useAverage, ytValue, useLog]
+        
         subkuvakansio = FileSystem.createSubfolder(kuvakansio, muuttuja)
-        for i in range(timeSpan):
+        animationFile = subkuvakansio / fileName
+        
+        if animationFile.suffix == ".mp4" and shutil.which(matplotlib.rcParams["animation.ffmpeg_path"]) is None:
+            raise RuntimeError("ffmpeg not found from {0}, set rcParams[\"animation.ffmpeg_path\"]".format(matplotlib.rcParams["animation.ffmpeg_path"]))
+        
+        with concurrent.futures.ProcessPoolExecutor(max_workers = maxWorkers) as executor:
+            if vmin is None or vmax is None:
+                ranges = numpy.asarray(list(executor.map( Plot._getAnimationFrameRange,
+                                                          *zip(*[ fieldArguments + [i] for i in frames ]),
+                                                          chunksize = 8 )))
+                if vmin is None:
+                    vmin = numpy.nanmin(ranges[:,0])
+                if vmax is None:
+                    vmax = numpy.nanmax(ranges[:,1])
             
-            fig, ax = plot_alustus()
-            plottable = dataAnim.isel(time=i)
-            plottable.plot(x = "xt", y = "zt",ax = ax, add_colorbar = False, cmap = "Blues_r") #, levels = levels
-            ax.set_title("time = " +"{:5.1f} (h)".format(plottable.time.values) )
-            ax.set_ylabel("height (m)")
-            ax.set_xlabel("East-west displacement of cell centers (m)")
-            saveFig(subkuvakansio, muuttuja + "_{:04d}".format(i))
-        
-        origDir = os.getcwd()    
-        os.chdir(subkuvakansio)
-        os.system("convert -delay 50 -loop 0 *.png animation.gif")
-        os.chdir(origDir)    
+            frameCalls = [ [*fieldArguments, i, timeH[i], vmin, vmax, cmap, figsize, dpi] for i in frames ]
+            
+            encoder = None
+            paletteFrames = []
+            try:
+                for frame in Plot._getOrderedResults(executor, Plot._renderAnimationFrame, frameCalls,
+                                                     inFlight = 2 * (maxWorkers or os.cpu_count())):
+                    if animationFile.suffix == ".mp4":
+                        if encoder is None:
+                            encoder = Plot._getMP4Encoder(animationFile, frame.shape, frameDuration)
+                        Plot._writeMP4Frame(encoder, frame, animationFile)
+                    else:
+                        paletteFrames.append(PIL.Image.fromarray(frame).quantize())
+            except BaseException:
+                if encoder is not None and encoder.poll() is None:
+                    encoder.kill()
+                    encoder.communicate()
+                raise
+        
+        if animationFile.suffix == ".mp4":
+            if encoder is not None:
+                Plot._closeMP4Encoder(encoder, animationFile)
+        elif len(paletteFrames) > 0:
+            paletteFrames[0].save(animationFile, save_all = True, append_images = paletteFrames[1:],
+                                  duration = frameDuration, loop = 0)
+        
+        return animationFile
+    
+    def _getOrderedResults(executor, function, calls, inFlight):
+        """
+        yields the results of function(*arguments) for arguments in calls in order,
+        keeping at most inFlight calls submitted at a time
+        """
+        pending = collections.deque()
+        for arguments in calls:
+            pending.append(executor.submit(function, *arguments))
+            if len(pending) >= inFlight:
+                yield pending.popleft().result()
+        
+        while len(pending) > 0:
+            yield pending.popleft().result()
+    
+    def _getAnimationField(fileNameNC, muuttuja, useAverage, ytValue, useLog, timeInd):
+        if fileNameNC not in Plot._animationDatasets:
+            Plot._animationDatasets[fileNameNC] = xarray.open_dataset(fileNameNC)
+        
+        field = Plot._animationDatasets[fileNameNC][muuttuja].isel(time = timeInd)
+        
+        if useAverage:
+            if useLog:
+                field = field.copy(data = numpy.ma.log10(field.values).filled(0))
+            field = field.mean(dim="yt")
+        else:
+            field = field.sel(yt = ytValue, method="nearest")
+            if useLog:
+                field = field.copy(data = numpy.ma.log10(field.values).filled(0))
+        
+        return field
+    
+    def _getAnimationFrameRange(fileNameNC, muuttuja, useAverage, ytValue, useLog, timeInd):
+        field = Plot._getAnimationField(fileNameNC, muuttuja, useAverage, ytValue, useLog, timeInd).values
+        
+        return numpy.nanmin(field), numpy.nanmax(field)
+    
+    def _renderAnimationFrame(fileNameNC, muuttuja, useAverage, ytValue, useLog, timeInd, timeH,
+                              vmin, vmax, cmap, figsize, dpi):
+        plottable = Plot._getAnimationField(fileNameNC, muuttuja, useAverage, ytValue, useLog, timeInd)
+        
+        fig = matplotlib.figure.Figure(figsize = figsize, dpi = dpi)
+        canvas = matplotlib.backends.backend_agg.FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        
+        plottable.plot(x = "xt", y = "zt",ax = ax, add_colorbar = False, cmap = cmap,
+                       norm = matplotlib.colors.Normalize(vmin = vmin, vmax = vmax))
+        ax.set_title("time = " +"{:5.1f} (h)".format(timeH) )
+        ax.set_ylabel("height (m)")
+        ax.set_xlabel("East-west displacement of cell centers (m)")
+        
+        canvas.draw()
+        
+        return numpy.asarray(canvas.buffer_rgba())[:, :, :3].copy()
+    
+    def _getMP4Encoder(animationFile, frameShape, frameDuration):
+        try:
+            return subprocess.Popen([matplotlib.rcParams["animation.ffmpeg_path"], "-y", "-loglevel", "error",
+                                     "-f", "rawvideo", "-pix_fmt", "rgb24",
+                                     "-s", "{0}x{1}".format(frameShape[1], frameShape[0]),
+                                     "-r", str(1000. / frameDuration), "-i", "-",
+                                     "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+                                     "-pix_fmt", "yuv420p", str(animationFile)],
+                                    stdin = subprocess.PIPE,
+                                    stderr = subprocess.PIPE)
+        except OSError as error:
+            raise RuntimeError("Starting ffmpeg failed writing {0}: {1}".format(animationFile, error)) from error
+    
+    def _writeMP4Frame(encoder, frame, animationFile):
+        try:
+            encoder.stdin.write(frame.tobytes())
+        except BrokenPipeError as error:
+            Plot._closeMP4Encoder(encoder, animationFile)
+            raise RuntimeError(f"ffmpeg closed its input while writing {animationFile}") from error
+    
+    def _closeMP4Encoder(encoder, animationFile):
+        """closes the input of the ffmpeg encoder, waits for it and raises its error output if it failed"""
+        # with -loglevel error the stderr pipe stays small enough to be read only at the end
+        stderr = encoder.communicate()[1]
+        if encoder.returncode != 0:
+            raise RuntimeError("ffmpeg failed with exit code {0} writing {1}: {2}".format(encoder.returncode, animationFile,
+                                                                                        stderr.decode(errors = "replace").strip()))
@@ -7,6 +7,7 @@ Created on Mon Jan 20 13:30:13 2020
 @licence: MIT licence Copyright
 """
 import matplotlib
+import matplotlib.artist
 import numpy
 import time
 
@@ -85,7 +86,7 @@ class PlotTweak:
     def hideYTickLabels(ax):
         PlotTweak._hideAllTickLabels(ax.get_yticklabels)
     def _hideAllTickLabels(axTicksGetter):
-        matplotlib.pyplot.setp(axTicksGetter()[:], visible=False)
+        matplotlib.artist.setp(axTicksGetter()[:], visible=False)
 
     def setXTickSizes(ax, labelListMajorLineBoolean,
                   majorFontsize = 7,
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 13:40:05 2026
+
+@author: Jaakko Ahola, Finnish Meteorological Institute
+@licence: MIT licence Copyright
+"""
+import math
+import numpy
+import pandas
+
+class QuantileSketch:
+    """
+    Mergeable approximate quantile sketch of a stream of values (KLL-type compactors).
+
+    Values are added in chunks with update and sketches of separate chunks or
+    simulations can be combined with merge. Memory is O(k log(n/k)) and the rank
+    error is roughly 1/k. Minimum and maximum are kept exactly and NaN values are ignored.
+    """
+
+    def __init__(self, k = 200, seed = None):
+        self.k = k
+        self.count = 0
+        self.minimum = numpy.inf
+        self.maximum = -numpy.inf
+        self.compactors = [numpy.empty(0)]
+        self.rng = numpy.random.default_rng(seed)
+
+    def update(self, values):
+        values = numpy.asarray(values, dtype = float).ravel()
+        values = values[~numpy.isnan(values)]
+        if values.shape[0] == 0:
+            return self
+
+        self.count += values.shape[0]
+        self.minimum = min(self.minimum, values.min())
+        self.maximum = max(self.maximum, values.max())
+
+        self.compactors[0] = numpy.concatenate((self.compactors[0], values))
+        self._compress()
+
+        return self
+
+    def merge(self, other):
+        """adds the values of other QuantileSketch to this one"""
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append(numpy.empty(0))
+
+        for level, compactor in enumerate(other.compactors):
+            self.compactors[level] = numpy.concatenate((self.compactors[level], compactor))
+
+        self.count += other.count
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self._compress()
+
+        return self
+
+    def quantile(self, quantiles):
+        """returns approximate values at quantiles (float or list of floats in [0, 1])"""
+        scalar = numpy.ndim(quantiles) == 0
+        quantiles = numpy.atleast_1d(numpy.asarray(quantiles, dtype = float))
+
+        if self.count == 0:
+            result = numpy.full(quantiles.shape, numpy.nan)
+        else:
+            values = numpy.concatenate(self.compactors)
+            weights = numpy.concatenate([numpy.full(compactor.shape[0], 2.**level)
+                                         for level, compactor in enumerate(self.compactors)])
+            order = numpy.argsort(values, kind = "stable")
+            values = values[order]
+            cumulative = numpy.cumsum(weights[order])
+
+            indexes = numpy.searchsorted(cumulative, quantiles * cumulative[-1], side = "left")
+            result = values[numpy.clip(indexes, 0, values.shape[0] - 1)]
+            result = numpy.where(quantiles <= 0., self.minimum, result)
+            result = numpy.where(quantiles >= 1., self.maximum, result)
+
+        if scalar:
+            return result[0]
+        return result
+
+    def getCount(self):
+        return self.count
+
+    def _getCapacity(self, level):
+        depth = len(self.compactors) - level - 1
+        return max(2, int(math.ceil(self.k * (2./3.)**depth)))
+
+    def _compress(self):
+        level = 0
+        while level < len(self.compactors):
+            compactor = self.compactors[level]
+            if compactor.shape[0] > self._getCapacity(level):
+                if level + 1 == len(self.compactors):
+                    self.compactors.append(numpy.empty(0))
+
+                compactor = numpy.sort(compactor)
+                even = compactor.shape[0] - compactor.shape[0] % 2
+                offset = self.rng.integers(2)
+
+                self.compactors[level + 1] = numpy.concatenate((self.compactors[level + 1], compactor[offset:even:2]))
+                self.compactors[level] = compactor[even:]
+            level += 1
+
+    def fromDataFrame(dataframe : pandas.DataFrame, variables : list, k = 200, seed = None):
+        """returns a dictionary variable -> QuantileSketch of the columns of dataframe"""
+        return {variable : QuantileSketch(k, seed).update(dataframe[variable].to_numpy(dtype = float))
+                for variable in variables}
+
+    def mergeSketches(sketchCollections : list):
+        """merges a list of dictionaries variable -> QuantileSketch into a new dictionary"""
+        merged = {}
+        for sketches in sketchCollections:
+            for variable, sketch in sketches.items():
+                if variable not in merged:
+                    merged[variable] = QuantileSketch(sketch.k)
+                merged[variable].merge(sketch)
+
+        return merged
+
+    def getQuantileSummary(sketches : dict, variables : list, quantiles : list):
+        """returns a DataFrame of quantiles (index) by variables (columns) like Data.getQuantileSummary"""
+        quantiles = sorted(set(quantiles))
+
+        return pandas.DataFrame({variable : sketches[variable].quantile(quantiles) for variable in variables},
+                                index = pandas.Index(quantiles))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 15:02:48 2026
+
+@author: Jaakko Ahola, Finnish Meteorological Institute
+@licence: MIT licence Copyright
+"""
+import collections.abc
+import numpy
+
+class Ranking(collections.abc.Mapping):
+    """
+    Read-only dictionary of id -> value backed by parallel numpy arrays.
+
+    Iterates in ascending value order like Data.sortDictionary (ties in insertion order),
+    the full sort is done only when needed. Tails are selected with numpy.partition in O(n)
+    and contain the same keys as Data.getLowTail / getHighTail of the sorted dictionary.
+    """
+
+    def __init__(self, ids, values):
+        self.ids = numpy.asarray(ids, dtype = object)
+        self.values = numpy.asarray(values)
+        self.order = None
+        self.idIndex = None
+
+        if self.ids.shape != self.values.shape:
+            raise ValueError(f"ids and values have different shapes {self.ids.shape} {self.values.shape}")
+
+    def fromDictionary(dictionary : dict):
+        return Ranking(list(dictionary), list(dictionary.values()))
+
+    def __getitem__(self, key):
+        if self.idIndex is None:
+            self.idIndex = {key : ind for ind, key in enumerate(self.ids)}
+        return self.values[self.idIndex[key]]
+
+    def __iter__(self):
+        return iter(self.ids[self._getOrder()])
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def getIDs(self):
+        """ids in ascending value order"""
+        return self.ids[self._getOrder()]
+
+    def getValues(self):
+        """values in ascending order"""
+        return self.values[self._getOrder()]
+
+    def getLowTail(self, fraction):
+        """returns the Ranking of the int(len*fraction) lowest values or a list of them for a list of fractions"""
+        return self._getTails(fraction, high = False)
+
+    def getHighTail(self, fraction):
+        """returns the Ranking of the int(len*fraction) highest values or a list of them for a list of fractions"""
+        return self._getTails(fraction, high = True)
+
+    def getHighAndLowTail(self, fraction : float):
+        """returns the Ranking of the low tail followed by the high tail like Data.getHighAndLowTail"""
+        indexes = numpy.concatenate((self._getTailIndexes([fraction], high = False)[0],
+                                     self._getTailIndexes([fraction], high = True)[0]))
+        indexes = indexes[numpy.sort(numpy.unique(indexes, return_index = True)[1])]
+
+        return Ranking(self.ids[indexes], self.values[indexes])
+
+    def _getOrder(self):
+        if self.order is None:
+            self.order = numpy.argsort(self.values, kind = "stable")
+        return self.order
+
+    def _getTails(self, fraction, high):
+        tails = [Ranking(self.ids[indexes], self.values[indexes])
+                 for indexes in self._getTailIndexes(numpy.atleast_1d(fraction), high)]
+
+        if numpy.ndim(fraction) == 0:
+            return tails[0]
+        return tails
+
+    def _getTailIndexes(self, fractions, high):
+        sizes = [int(len(self)*fraction) for fraction in fractions]
+
+        nonEmpty = sorted({size for size in sizes if size > 0})
+        if high:
+            kth = [len(self) - size for size in nonEmpty]
+        else:
+            kth = [size - 1 for size in nonEmpty]
+        thresholds = dict(zip(nonEmpty, numpy.partition(self.values, kth)[kth])) if len(kth) > 0 else {}
+
+        tailIndexes = []
+        for size in sizes:
+            if size == 0:
+                indexes = numpy.empty(0, dtype = int)
+            elif high:
+                threshold = thresholds[size]
+                beyond = numpy.flatnonzero(self.values > threshold)
+                equal = numpy.flatnonzero(self.values == threshold)
+                indexes = numpy.concatenate((beyond, equal[len(equal) - (size - len(beyond)):]))
+            else:
+                threshold = thresholds[size]
+                beyond = numpy.flatnonzero(self.values < threshold)
+                equal = numpy.flatnonzero(self.values == threshold)
+                indexes = numpy.concatenate((beyond, equal[:size - len(beyond)]))
+
+            indexes = numpy.sort(indexes)
+            tailIndexes.append(indexes[numpy.argsort(self.values[indexes], kind = "stable")])
+
+        return tailIndexes
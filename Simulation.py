@@ -6,15 +6,30 @@ Created on Fri Jan 10 13:14:55 2020
 @author: Jaakko Ahola, Finnish Meteorological Institute
 @licence: MIT licence Copyright
 """
+import contourpy
+import importlib.util
 import numpy
+import pandas
 import pathlib
 import xarray
 from Data import Data
+from FileSystem import FileSystem
 import sys
 
 class Simulation:
     
-    def __init__(self, folder, label, color, linewidth = None, zorder = 1):
+    def __init__(self, folder, label, color, linewidth = None, zorder = 1, chunks = None, simulationID = None):
+        """
+        simulationID : str, optional
+            identifier of the simulation in a collection, see InputSimulation.getSimulationCollection
+        chunks : dict, optional
+            per-dimension chunk sizes, e.g.
+            {"time" : 60, "zt" : 50, "xt" : 64, "yt" : 64, "aeb" : 7}.
+            If given, datasets are opened lazily as dask arrays so that only the
+            slices that are actually used are read from disk. Dimensions that are
+            not found from a file are ignored. None opens datasets without chunking.
+            Requires the optional dependency dask: pip install les-03plotting[lazy]
+        """
         self.folder = pathlib.Path(folder)
         self.label = label
         self.color = color
@@ -28,14 +43,21 @@ class Simulation:
         
         self.linewidth = linewidth
         
-        self.__ncHours = False
-        self.__psHours = False
-        self.__tsHours = False
-        
         self.zorder = zorder
         
         self.AUXDatasets = {}
-        self.__AuxHours = False
+        
+        self.chunks = chunks
+        
+        self.simulationID = simulationID
+        
+        self._cloudLayerMasks = {}
+        self._cloudLayerMeans = {}
+        
+        self._timeAxes = {}
+        self._timeCoordinates = {}
+        
+        self._isolines = {}
         
     def getColor(self):
         return self.color
@@ -52,6 +74,12 @@ class Simulation:
     def getFolder(self):
         return self.folder
     
+    def getChunks(self):
+        return self.chunks
+    
+    def getID(self):
+        return self.simulationID
+    
     def getNCDatasetFileName(self):
         if self.ncFilename is None:
             self.ncFilename = self._getDatasetFileName("")
@@ -70,7 +98,7 @@ class Simulation:
     def getNCDataset(self):
         if self.nc is None:
             try:
-                self.nc = xarray.open_dataset(self.getNCDatasetFileName())
+                self.nc = self._openDataset(self.getNCDatasetFileName())
             except FileNotFoundError:
                 sys.exit(f".nc file not found from {self.folder}")
             
@@ -79,7 +107,7 @@ class Simulation:
     def getPSDataset(self):
         if self.ps is None:
             try:
-                self.ps = xarray.open_dataset(self.getPSDatasetFileName())
+                self.ps = self._openDataset(self.getPSDatasetFileName())
             except FileNotFoundError:
                 sys.exit(f".ps.nc file not found from {self.folder}")
             
@@ -88,89 +116,363 @@ class Simulation:
     def getTSDataset(self):
         if self.ts is None:
             try:
-                self.ts = xarray.open_dataset(self.getTSDatasetFileName())
+                self.ts = self._openDataset(self.getTSDatasetFileName())
             except FileNotFoundError:
                 sys.exit(f".ts.nc file not found from {self.folder}")    
         
         return self.ts
     
+    def openDataset(self, kind, filename = None):
+        """
+        Opens and returns the dataset of the given kind ("nc", "ps", "ts" or "aux")
+        without storing it to the object. Unlike the getters this raises
+        FileNotFoundError instead of exiting. For kind "aux" filename is relative to folder.
+        """
+        if kind == "aux":
+            filename = self.folder / filename
+        elif filename is None:
+            filename = {"nc" : self.getNCDatasetFileName,
+                        "ps" : self.getPSDatasetFileName,
+                        "ts" : self.getTSDatasetFileName}[kind]()
+        
+        if filename is None or not pathlib.Path(filename).exists():
+            raise FileNotFoundError(f"{kind} file not found from {self.folder}")
+        
+        return self._openDataset(filename)
+    
+    def setDataset(self, kind, dataset, key = None):
+        if kind == "nc":
+            self.setNCDataset(dataset)
+        elif kind == "ps":
+            self.setPSDataset(dataset)
+        elif kind == "ts":
+            self.setTSDataset(dataset)
+        elif kind == "aux":
+            self.updateAUXDataset(key, dataset)
+    
     def setAUXDataset(self, key, filename):
         
-        self.AUXDatasets[key] = xarray.open_dataset( self.folder / filename )
+        self.AUXDatasets[key] = self._openDataset( self.folder / filename )
+        self._resetCaches("aux")
     
     def updateAUXDataset(self, key, dataset):
         self.AUXDatasets[key] = dataset
+        self._resetCaches("aux")
     
     def getAUXDataset(self, key):
         return self.AUXDatasets[key]
         
     
+    def _openDataset(self, filename):
+        if self.chunks is None:
+            return xarray.open_dataset(filename)
+        
+        if importlib.util.find_spec("dask") is None:
+            raise ImportError("Simulation chunks require dask, install it with: pip install les-03plotting[lazy]")
+        
+        # chunked on open so that only the used chunks are read, xarray skips dimensions missing from the file
+        return xarray.open_dataset(filename, chunks = self.chunks)
+    
     def _getDatasetFileName(self, ncMode):
-        if "." not in ncMode:
-            ncModeSuffix = "." + ncMode
-        
-        fileAbs = None
-        for ncFile in list(self.folder.glob("*.nc")):
-            if ncMode != "":
-                if ncModeSuffix in ncFile.suffixes:
-                    fileAbs = ncFile
-                    break
-            else:
-                if ".ps" not in ncFile.suffixes and ".ts" not in ncFile.suffixes:
-                    fileAbs = ncFile
-                    break
+        if ncMode == "":
+            fileAbs = FileSystem.getNCFile(self.folder, "main")
+            if fileAbs is None:
+                fileAbs = FileSystem.getNCFile(self.folder, "aux")
+        else:
+            fileAbs = FileSystem.getNCFile(self.folder, ncMode.strip("."))
+        
         return fileAbs
     
     def setNCDataset(self, nc):
         self.nc = nc
+        self._resetCaches("nc")
     
     def setTSDataset(self, ts):
         self.ts = ts
+        self._resetCaches("ts")
     
     def setPSDataset(self,ps):
         self.ps = ps
+        self._resetCaches("ps")
     
     def setZorder(self, zorder):
         self.zorder = zorder
+    
+    def setChunks(self, chunks):
+        self.chunks = chunks
         
+    def sliceByTime(self, timeStart, timeEnd, kinds = None):
+        """
+        Slices the datasets of the given kinds ("nc", "ps", "ts", "aux") to the
+        time steps closest to timeStart and timeEnd (inclusive). kinds None slices
+        all loaded datasets. The time axes are searched with a binary search and
+        the slices are views of the original data.
+        """
+        if kinds is None:
+            kinds = [kind for kind in ["nc", "ps", "ts"] if getattr(self, kind) is not None]
+            if bool(self.AUXDatasets):
+                kinds.append("aux")
+        
+        for kind in kinds:
+            if kind == "aux":
+                for key in self.AUXDatasets:
+                    self.AUXDatasets[key] = self.__sliceByTimeDataset(("aux", key), self.AUXDatasets[key], timeStart, timeEnd)
+            else:
+                dataset = {"nc" : self.getNCDataset,
+                           "ps" : self.getPSDataset,
+                           "ts" : self.getTSDataset}[kind]()
+                setattr(self, kind, self.__sliceByTimeDataset(kind, dataset, timeStart, timeEnd))
+        
+        if "ps" in kinds or "ts" in kinds:
+            self._resetCloudLayerCache()
+        if "ps" in kinds:
+            self._resetIsolineCache()
+    
     def sliceByTimeNCDataset(self,timeStart, timeEnd):
         
-        self.nc = self.__sliceByTimeDataset( self.getNCDataset(), timeStart, timeEnd)
+        self.sliceByTime(timeStart, timeEnd, kinds = ["nc"])
         
         return self.nc
         
     def sliceByTimePSDataset(self,timeStart, timeEnd):
         
-        self.ps = self.__sliceByTimeDataset(self.getPSDataset(),timeStart, timeEnd)
+        self.sliceByTime(timeStart, timeEnd, kinds = ["ps"])
         
         return self.ps
         
     def sliceByTimeTSDataset(self,timeStart, timeEnd):
         
-        self.ts = self.__sliceByTimeDataset(self.getPSDataset(), timeStart, timeEnd)    
+        self.sliceByTime(timeStart, timeEnd, kinds = ["ts"])
         
         return self.ts
     
     def sliceByTimeAUXDataset(self, timeStart, timeEnd):
-        for key in self.AUXDatasets:
-            self.AUXDatasets[key] = self.__sliceByTimeDataset(self.AUXDatasets[key], timeStart, timeEnd)
+        self.sliceByTime(timeStart, timeEnd, kinds = ["aux"])
+    
+    def getTimeAxis(self, kind, key = None):
+        """
+        Returns the time values of the dataset of kind ("nc", "ps", "ts" or "aux" with key)
+        as a numpy array, cached until the dataset is replaced
+        """
+        cacheKey = kind if kind != "aux" else ("aux", key)
+        if cacheKey not in self._timeAxes:
+            if kind == "aux":
+                dataset = self.getAUXDataset(key)
+            else:
+                dataset = {"nc" : self.getNCDataset,
+                           "ps" : self.getPSDataset,
+                           "ts" : self.getTSDataset}[kind]()
+            self._timeAxes[cacheKey] = dataset["time"].values
         
+        return self._timeAxes[cacheKey]
     
-    def __sliceByTimeDataset(self, dataSet, timeStart, timeEnd):
-        timeStartInd = Data.getClosestIndex( dataSet.time.values, timeStart )
-        timeEndInd   = Data.getClosestIndex( dataSet.time.values, timeEnd ) + 1
+    def __sliceByTimeDataset(self, cacheKey, dataSet, timeStart, timeEnd):
+        if cacheKey not in self._timeAxes:
+            self._timeAxes[cacheKey] = dataSet["time"].values
+        time = self._timeAxes[cacheKey]
+        
+        timeStartInd, timeEndInd = Data.getClosestIndexSorted( time, [timeStart, timeEnd] )
+        timeEndInd = timeEndInd + 1
+        
+        self._timeAxes[cacheKey] = time[timeStartInd:timeEndInd]
+        for coordinateKey in list(self._timeCoordinates):
+            if coordinateKey[0] == cacheKey:
+                self._timeCoordinates[coordinateKey] = self._timeCoordinates[coordinateKey][timeStartInd:timeEndInd]
         
         return  dataSet.isel(time = slice(timeStartInd,timeEndInd))
-
+    
+    def getCloudLayerMasks(self, limit = 1e-6, layers = ("inCloud", "belowCloud", "aboveCloud")):
+        """
+        Returns (cloudLayer, time, zt) weights of the PS levels that are
+        in cloud (P_rl > limit and P_ri > limit),
+        below cloud (P_rl < limit and zt < ts.zb) and
+        above cloud (zt > ts.zc).
+        Cloud base and top from the TS dataset are matched to the PS time axis by nearest time.
+        The masks are computed once per simulation and limit.
+        """
+        cacheKey = (limit, tuple(layers))
+        if cacheKey in self._cloudLayerMasks:
+            return self._cloudLayerMasks[cacheKey]
+        
+        ps = self.getPSDataset()
+        if "belowCloud" in layers or "aboveCloud" in layers:
+            ts = self.getTSDataset()
+            # matched in seconds so that the units of the ps and ts coordinates may differ
+            tsTimeInd = xarray.DataArray(Data.getClosestIndexSorted( self.getTimeCoordinate("ts", "s").values,
+                                                                     self.getTimeCoordinate("ps", "s").values ),
+                                         dims = "time")
+        
+        masks = []
+        for layer in layers:
+            if layer == "inCloud":
+                mask = (ps["P_rl"] > limit) & (ps["P_ri"] > limit)
+            elif layer == "belowCloud":
+                zb = ts["zb"].isel(time = tsTimeInd).assign_coords(time = ps["time"])
+                mask = (ps["P_rl"] < limit) & (ps["zt"] < zb)
+            elif layer == "aboveCloud":
+                zc = ts["zc"].isel(time = tsTimeInd).assign_coords(time = ps["time"])
+                mask = (ps["zt"] > zc)
+            else:
+                raise ValueError(f"Unknown cloud layer {layer}")
+            masks.append(mask.transpose("time", "zt").astype(float))
+        
+        masks = xarray.concat(masks, dim = "cloudLayer").assign_coords(cloudLayer = list(layers)).load()
+        
+        self._cloudLayerMasks[cacheKey] = masks
+        
+        return masks
+    
+    def getCloudLayerMeans(self, variables, limit = 1e-6, layers = ("inCloud", "belowCloud", "aboveCloud")):
+        """
+        Returns a Dataset of the vertical means of the PS variables over the
+        cloud layers with a new dimension cloudLayer, e.g.
+        simulation.getCloudLayerMeans(["P_Nabb", "P_Ncbb"]).sel(cloudLayer = "inCloud").
+        NaN values are skipped and time steps without any level in the layer are NaN.
+        """
+        if isinstance(variables, str):
+            variables = [variables]
+        
+        ps = self.getPSDataset()
+        masks = self.getCloudLayerMasks(limit, layers)
+        
+        means = {}
+        for variable in variables:
+            cacheKey = (variable, limit, tuple(layers))
+            if cacheKey not in self._cloudLayerMeans:
+                data = ps[variable]
+                sums = xarray.dot(data.fillna(0.), masks, dim = "zt")
+                counts = xarray.dot(data.notnull().astype(float), masks, dim = "zt")
+                self._cloudLayerMeans[cacheKey] = (sums / counts.where(counts > 0)).rename(variable)
+            means[variable] = self._cloudLayerMeans[cacheKey]
+        
+        return xarray.Dataset(means)
+    
+    def getBinProportions(self, mode = "inCloud", limit = 1e-6, height = None, packing = None,
+                          timeStartH = None, timeEndH = None):
+        """
+        Returns a Dataset of the B bin number concentrations of the species with dimensions
+        (species, time, dryRadiusBinB) averaged over the cloud layer mode ("inCloud", "belowCloud"
+        or "aboveCloud", from the cached getCloudLayerMeans) or at height (mode "height"):
+            number : per species
+            total : sum over the species
+            fraction : number / total
+            totalRelative : total relative to the first time step with a finite total, per bin
+        With packing the bins from index packing onwards are summed into one bin.
+        Time is in hours and sliced with [timeStartH, timeEndH).
+        """
+        variables = {"aerosol" : "P_Nabb", "cloud" : "P_Ncbb", "ice" : "P_Nibb"}
+        
+        if mode in ["inCloud", "belowCloud", "aboveCloud"]:
+            data = self.getCloudLayerMeans(list(variables.values()), limit).sel(cloudLayer = mode, drop = True)
+        elif mode == "height":
+            data = self.getPSDataset()[list(variables.values())].sel(zt = height, method = "nearest")
+        else:
+            raise ValueError(f"Unknown mode {mode}")
+        
+        timeH = self.getTimeCoordinate("ps", "h")
+        timeStartInd, timeEndInd = 0, timeH.shape[0]
+        if timeStartH is not None:
+            timeStartInd = int(Data.getClosestIndexSorted( timeH.values, timeStartH ))
+        if timeEndH is not None:
+            timeEndInd = int(Data.getClosestIndexSorted( timeH.values, timeEndH ))
+        timeSlice = slice(timeStartInd, timeEndInd)
+        
+        # bins are paired by position, the size bin coordinates of the species differ
+        number = numpy.stack([ data[variable].isel(time = timeSlice).transpose("time", ...).values
+                               for variable in variables.values() ])
+        number = xarray.DataArray(number,
+                                  dims = ["species", "time", "dryRadiusBinB"],
+                                  coords = {"species" : list(variables),
+                                            "time" : timeH[timeSlice].values,
+                                            "dryRadiusBinB" : numpy.arange(1, number.shape[-1] + 1)})
+        
+        if packing is not None:
+            number = xarray.concat([ number.isel(dryRadiusBinB = slice(0, packing)),
+                                     number.isel(dryRadiusBinB = slice(packing, None)).sum("dryRadiusBinB", skipna = False).expand_dims(dryRadiusBinB = [packing + 1]) ],
+                                   dim = "dryRadiusBinB")
+        
+        total = number.sum("species", skipna = False)
+        
+        # first finite total of each bin, like total.bfill("time").isel(time = 0) without bottleneck
+        firstTotal = total.isel(time = total.notnull().argmax("time")).drop_vars("time")
+        
+        proportions = xarray.Dataset({"number" : number,
+                                      "total" : total,
+                                      "fraction" : number / total,
+                                      "totalRelative" : total / firstTotal})
+        proportions["time"].attrs["units"] = "h"
+        
+        return proportions
+    
+    def _resetCloudLayerCache(self):
+        self._cloudLayerMasks = {}
+        self._cloudLayerMeans = {}
+    
+    def getIsolines(self, variable, value, unit = "h"):
+        """
+        Returns the isolines of the PS variable at value on the time-height plane as a list
+        of (point, 2) arrays of (time in unit, zt), e.g. for a LineCollection. The lines are
+        traced once per (variable, value, unit) and shared until the PS dataset is replaced.
+        """
+        cacheKey = (variable, value, unit)
+        if cacheKey not in self._isolines:
+            data = self.getPSDataset()[variable].transpose("zt", "time")
+            
+            generator = contourpy.contour_generator(x = self.getTimeCoordinate("ps", unit).values,
+                                                    y = data["zt"].values,
+                                                    z = numpy.ma.masked_invalid(data.values),
+                                                    line_type = "Separate")
+            
+            self._isolines[cacheKey] = generator.lines(value)
+        
+        return self._isolines[cacheKey]
+    
+    def _resetIsolineCache(self):
+        self._isolines = {}
+    
+    def getSizeDistributionPoints(self, variables, heights, timesH):
+        """
+        Returns a Dataset of the PS size distribution variables at the points
+        (heights[i], timesH[i]) with dimensions (point, size bin) read in one indexing.
+        heights and timesH are broadcast against each other and matched to the nearest zt and time,
+        the matched zt and time (h) are coordinates along point.
+        """
+        if isinstance(variables, str):
+            variables = [variables]
+        
+        ps = self.getPSDataset()
+        heights, timesH = numpy.broadcast_arrays(numpy.atleast_1d(heights), numpy.atleast_1d(timesH))
+        
+        heightInd = Data.getClosestIndexSorted( ps["zt"].values, heights )
+        timeInd = Data.getClosestIndexSorted( self.getTimeCoordinate("ps", "h").values, timesH )
+        
+        points = ps[list(variables)].isel(zt = xarray.DataArray(heightInd, dims = "point"),
+                                          time = xarray.DataArray(timeInd, dims = "point"))
+        points = points.assign_coords(time = ("point", self.getTimeCoordinate("ps", "h").values[timeInd], {"units" : "h"}))
+        
+        return points.load()
+    
+    def _resetCaches(self, kind):
+        for cacheKey in list(self._timeAxes):
+            if cacheKey == kind or (kind == "aux" and isinstance(cacheKey, tuple)):
+                del self._timeAxes[cacheKey]
+        for coordinateKey in list(self._timeCoordinates):
+            cacheKey = coordinateKey[0]
+            if cacheKey == kind or (kind == "aux" and isinstance(cacheKey, tuple)):
+                del self._timeCoordinates[coordinateKey]
+        if kind in ["ps", "ts"]:
+            self._resetCloudLayerCache()
+        if kind == "ps":
+            self._resetIsolineCache()
     
     # needs revision
     def getEntrainment(self,
                        divergence = 5.e-6):
         ts = self.getTSDataset()
         z = ts.zi1_bar.values
-        t = ts.time.values
+        t = self.getTimeCoordinate("ts", "s").values
         dzdt = numpy.diff(z) / numpy.diff(t)
-        we = xarray.DataArray( dzdt + divergence*z[1:], dims={"h":ts.time.values[1:]/3600}, coords = {"time":ts.time.values[1:]/3600}, attrs={"longname":"Entrainment velocity", "units":"m/s"})
+        we = xarray.DataArray( dzdt + divergence*z[1:], dims="time", coords = {"time":t[1:]/3600}, attrs={"longname":"Entrainment velocity", "units":"m/s"})
         return we
     
     ####
@@ -197,19 +499,68 @@ class Simulation:
         return dataset
     
     def setTimeCoordToHours(self):
-        if self.nc is not None and (not self.__ncHours):
-            self.nc = self.nc.assign_coords(time = (self.nc.time / 3600))
-            self.__ncHours = True
-        if self.ps is not None and (not self.__psHours):
-            self.ps = self.ps.assign_coords(time = (self.ps.time / 3600))
-            self.__psHours = True
-        if self.ts is not None and (not self.__tsHours):
-            self.ts = self.ts.assign_coords(time = (self.ts.time / 3600))
-            self.__tsHours = True
-        if bool(self.AUXDatasets) and (not self.__AuxHours):
-            for key in self.AUXDatasets:
-                self.AUXDatasets[key] = self.AUXDatasets[key].assign_coords(time = (self.AUXDatasets[key].time / 3600))
-                self.__AuxHours = True
+        """
+        Replaces the time coordinate of the loaded datasets with the cached hours
+        view of getTimeCoordinate. Datasets already in hours are left untouched.
+        """
+        for kind in ["nc", "ps", "ts"]:
+            dataset = getattr(self, kind)
+            if dataset is not None and self.getTimeUnit(kind) != "h":
+                setattr(self, kind, dataset.assign_coords(time = self.getTimeCoordinate(kind, "h")))
+                self._timeAxes.pop(kind, None)
+        
+        for key in self.AUXDatasets:
+            if self.getTimeUnit("aux", key) != "h":
+                self.AUXDatasets[key] = self.AUXDatasets[key].assign_coords(time = self.getTimeCoordinate("aux", "h", key))
+                self._timeAxes.pop(("aux", key), None)
+        
+        self._resetCloudLayerCache()
+    
+    def getTimeUnit(self, kind, key = None):
+        """
+        returns the unit ("s" or "h") of the time coordinate currently used by the dataset of kind,
+        read from the units attribute of the coordinate ("h" after setTimeCoordToHours)
+        """
+        if kind == "aux":
+            dataset = self.getAUXDataset(key)
+        else:
+            dataset = {"nc" : self.getNCDataset,
+                       "ps" : self.getPSDataset,
+                       "ts" : self.getTSDataset}[kind]()
+        
+        if dataset["time"].attrs.get("units") == "h":
+            return "h"
+        return "s"
+    
+    def getTimeCoordinate(self, kind, unit = "h", key = None, origin = "unix"):
+        """
+        Returns the time coordinate of the dataset of kind ("nc", "ps", "ts" or "aux" with key)
+        in unit "s", "h" or "datetime" (seconds from origin) as a DataArray with dimension time,
+        e.g. dataarray.assign_coords(time = simulation.getTimeCoordinate("ps", "h")).
+        The coordinate is computed once per unit and shared until the dataset is replaced,
+        and it does not depend on whether setTimeCoordToHours has been used.
+        """
+        cacheKey = kind if kind != "aux" else ("aux", key)
+        coordinateKey = (cacheKey, unit, origin if unit == "datetime" else None)
+        
+        if coordinateKey not in self._timeCoordinates:
+            seconds = self.getTimeAxis(kind, key)
+            if self.getTimeUnit(kind, key) == "h":
+                seconds = seconds * 3600
+            
+            if unit == "s":
+                values = seconds
+            elif unit == "h":
+                values = seconds / 3600
+            elif unit == "datetime":
+                values = pandas.to_datetime(seconds, unit = "s", origin = origin).values
+            else:
+                raise ValueError(f"Unknown time unit {unit}")
+            
+            attrs = {} if unit == "datetime" else {"units" : unit}
+            self._timeCoordinates[coordinateKey] = xarray.DataArray(values, dims = "time", attrs = attrs)
+        
+        return self._timeCoordinates[coordinateKey]
     
     def setLineWidth(self, linewidth):
         self.linewidth = linewidth
@@ -8,7 +8,12 @@ Created on Thu May  7 10:38:34 2020
 """
 import time
 
+import hashlib
+import json
 import numpy
+import os
+import pandas
+import pathlib
 import sys
 import xarray
 from Simulation import Simulation
@@ -16,7 +21,16 @@ from Data import Data
 
 class SimulationDataAnalysis:
     
-    def __init__(self, simulation : Simulation, variableName, auxKey = None):
+    def __init__(self, simulation : Simulation, variableName, auxKey = None,
+                 useCache = False, cacheFolder = None, cacheMaxBytes = 2*1024**3):
+        """
+        useCache : bool
+            if True, the filtered and packed PS variables are stored as netCDF files
+            in cacheFolder (default: simulation folder / "derivedCache") and re-used when
+            the source files, the variable, the filter and its parameters are unchanged.
+        cacheMaxBytes : int
+            the least recently used cache files are removed when the cache grows above this size
+        """
         
         self.simulation = simulation
         
@@ -31,6 +45,16 @@ class SimulationDataAnalysis:
         self.sizeBinNameGroupedByBins = None
         
         self.auxKey = auxKey
+        
+        self.useCache = useCache
+        
+        if cacheFolder is None:
+            cacheFolder = pathlib.Path(simulation.getFolder()) / "derivedCache"
+        self.cacheFolder = pathlib.Path(cacheFolder)
+        
+        self.cacheMaxBytes = cacheMaxBytes
+        
+        self.filteredCacheKey = None
 
     def getFilteredVariableName(self):
         return self.filteredVariableName
@@ -54,7 +78,13 @@ class SimulationDataAnalysis:
         
         self.sizeBinNameGroupedByBins = self.sizeBinName + "_bins"
         
-        ps[self.filteredPackedVariableName] =  ps[self.filteredVariableName].groupby_bins( self.sizeBinName, bins).sum()
+        cacheKey = None
+        if self.useCache and self.filteredCacheKey is not None:
+            cacheKey = self._getCacheKey([], filteredCacheKey = self.filteredCacheKey,
+                                         sizeBinName = self.sizeBinName, packing = packing)
+        
+        ps[self.filteredPackedVariableName] = self._getCached(cacheKey,
+                                                              lambda : ps[self.filteredVariableName].groupby_bins( self.sizeBinName, bins).sum())
     
     def packFilteredAUXVariablewithSizeBinCoords(self, packing):
         
@@ -137,9 +167,11 @@ class SimulationDataAnalysis:
             self.filteredVariableName = self.variableName + "_filteredByAboveCloud"
         
         ps = self.simulation.getPSDataset()
-        ts = self.simulation.getTSDataset()
         
-        ps[self.filteredVariableName] = ps[self.variableName].where(ps["zt"] > ts["zc"], drop = True).mean(dim = "zt", skipna = True)
+        cacheKey = self._getFilterCacheKey("aboveCloud", useTS = True)
+        
+        ps[self.filteredVariableName] = self._getCached(cacheKey,
+                                                        lambda : self._getCloudLayerMean("aboveCloud"))
         
     
     def filterPSVariableInCloud(self, limit = 1e-6 ):
@@ -152,7 +184,10 @@ class SimulationDataAnalysis:
         
         ps = self.simulation.getPSDataset()
         
-        ps[self.filteredVariableName] = ps[self.variableName].where( (ps["P_rl"] > limit) & (ps["P_ri"] > limit), drop = True).mean(dim = "zt", skipna = True)
+        cacheKey = self._getFilterCacheKey("inCloud", limit = limit)
+        
+        ps[self.filteredVariableName] = self._getCached(cacheKey,
+                                                        lambda : self._getCloudLayerMean("inCloud", limit))
         
     
     def filterPSVariableBelowCloud(self, limit = 1e-6 ):
@@ -165,9 +200,11 @@ class SimulationDataAnalysis:
         
         
         ps = self.simulation.getPSDataset()
-        ts = self.simulation.getTSDataset()
         
-        ps[self.filteredVariableName] = ps[self.variableName].where(ps["P_rl"] < limit, drop = True).where(ps["zt"] < ts["zb"], drop = True).mean(dim = "zt", skipna = True) 
+        cacheKey = self._getFilterCacheKey("belowCloud", useTS = True, limit = limit)
+        
+        ps[self.filteredVariableName] = self._getCached(cacheKey,
+                                                        lambda : self._getCloudLayerMean("belowCloud", limit))
         
     def filterPSVariableAtHeight(self, height):
         
@@ -179,8 +216,94 @@ class SimulationDataAnalysis:
         
         ps = self.simulation.getPSDataset()
         
-        ps[self.filteredVariableName] = ps[self.variableName].sel(zt = height, method = 'nearest')
+        cacheKey = self._getFilterCacheKey("atHeight", height = height)
+        
+        ps[self.filteredVariableName] = self._getCached(cacheKey,
+                                                        lambda : ps[self.variableName].sel(zt = height, method = 'nearest'))
     
-                
-            
-            
+    def _getCloudLayerMean(self, layer, limit = 1e-6):
+        means = self.simulation.getCloudLayerMeans(self.variableName, limit)
+        
+        return means[self.variableName].sel(cloudLayer = layer, drop = True)
+    
+    def _getFilterCacheKey(self, mode, useTS = False, **parameters):
+        if not self.useCache:
+            return None
+        
+        sources = [self.simulation.getPSDatasetFileName()]
+        if useTS:
+            sources.append(self.simulation.getTSDatasetFileName())
+        
+        psTime = self.simulation.getPSDataset()["time"].values
+        
+        self.filteredCacheKey = self._getCacheKey(sources, variable = self.variableName, mode = mode,
+                                                  time = [float(psTime[0]), float(psTime[-1]), len(psTime)],
+                                                  **parameters)
+        return self.filteredCacheKey
+    
+    def _getCacheKey(self, sources, **parameters):
+        identity = []
+        for source in sources:
+            stat = os.stat(source)
+            identity.append([str(pathlib.Path(source).absolute()), stat.st_size, stat.st_mtime_ns])
+        
+        content = json.dumps([identity, parameters], sort_keys = True, default = str)
+        
+        return hashlib.sha1(content.encode()).hexdigest()
+    
+    def _getCached(self, cacheKey, compute):
+        """
+        returns the DataArray stored with cacheKey or computes and stores it
+        """
+        if cacheKey is None:
+            return compute()
+        
+        cacheFile = self.cacheFolder / (cacheKey + ".nc")
+        if cacheFile.exists():
+            dataarray = xarray.load_dataarray(cacheFile)
+            os.utime(cacheFile)
+            return SimulationDataAnalysis._restoreIntervalCoords(dataarray)
+        
+        dataarray = compute()
+        
+        self.cacheFolder.mkdir( parents=True, exist_ok = True )
+        temporaryFile = cacheFile.with_suffix(".tmp")
+        SimulationDataAnalysis._replaceIntervalCoords(dataarray).to_netcdf(temporaryFile)
+        os.replace(temporaryFile, cacheFile)
+        
+        self._evictCache()
+        
+        return dataarray
+    
+    def _replaceIntervalCoords(dataarray):
+        """
+        groupby_bins coordinates are pandas.Interval objects which netCDF cannot
+        store, so they are replaced by their left and right edges
+        """
+        for dim in dataarray.dims:
+            index = dataarray.indexes.get(dim)
+            if isinstance(index, pandas.IntervalIndex):
+                dataarray = dataarray.assign_coords({dim : numpy.arange(len(index)),
+                                                     dim + "_left" : (dim, index.left.values),
+                                                     dim + "_right" : (dim, index.right.values)})
+                dataarray[dim].attrs["closed"] = index.closed
+        return dataarray
+    
+    def _restoreIntervalCoords(dataarray):
+        for dim in dataarray.dims:
+            if dim + "_left" in dataarray.coords:
+                index = pandas.IntervalIndex.from_arrays(dataarray[dim + "_left"].values,
+                                                         dataarray[dim + "_right"].values,
+                                                         closed = dataarray[dim].attrs.get("closed", "right"))
+                dataarray = dataarray.drop_vars([dim + "_left", dim + "_right"]).assign_coords({dim : index})
+        return dataarray
+    
+    def _evictCache(self):
+        cacheFiles = sorted(self.cacheFolder.glob("*.nc"), key = lambda cacheFile : cacheFile.stat().st_mtime)
+        totalSize = sum(cacheFile.stat().st_size for cacheFile in cacheFiles)
+        
+        for cacheFile in cacheFiles:
+            if totalSize <= self.cacheMaxBytes:
+                break
+            totalSize -= cacheFile.stat().st_size
+            cacheFile.unlink()
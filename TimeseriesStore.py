@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:12:40 2026
+
+@author: Jaakko Ahola, Finnish Meteorological Institute
+@licence: MIT licence Copyright
+"""
+import numpy
+import pathlib
+import xarray
+
+from FileSystem import FileSystem
+
+class TimeseriesStore:
+    """
+    TS variables of a whole simulation collection in one memory-mapped .npy file
+    with shape (variable, simulation, time) and a YAML file of the simulation IDs,
+    variables, variable attributes and the common time axis in seconds.
+    Simulations with shorter or missing output are padded with NaN.
+    """
+    
+    def __init__(self, filename):
+        self.filename = pathlib.Path(filename).with_suffix(".npy")
+        
+        metadata = FileSystem.readYAML(self.filename.with_suffix(".yaml"))
+        
+        self.ids = metadata["ids"]
+        self.variables = metadata["variables"]
+        self.attrs = metadata["attrs"]
+        self.time = numpy.asarray(metadata["time"], dtype = float)
+        
+        self.idIndex = {simulationID : ind for ind, simulationID in enumerate(self.ids)}
+        self.variableIndex = {variable : ind for ind, variable in enumerate(self.variables)}
+        
+        self.data = numpy.load(self.filename, mmap_mode = "r")
+    
+    def create(simulationCollection : dict, variables : list, filename, dtype = numpy.float64):
+        """
+        Reads the TS variables of simulationCollection (ID -> Simulation) one
+        simulation at a time and writes them to filename. Returns the opened store.
+        """
+        filename = pathlib.Path(filename).with_suffix(".npy")
+        
+        ids = []
+        times = []
+        values = []
+        attrs = {variable : {} for variable in variables}
+        for simulationID, simulation in simulationCollection.items():
+            try:
+                ts = simulation.openDataset("ts")
+            except FileNotFoundError:
+                print("FileNotFoundError", simulationID, simulation.getFolder(), "TimeseriesStore.create")
+                continue
+            
+            with ts:
+                ids.append(simulationID)
+                times.append(ts["time"].values)
+                
+                simulationValues = []
+                for variable in variables:
+                    if variable in ts:
+                        simulationValues.append(ts[variable].values)
+                        if not attrs[variable]:
+                            attrs[variable] = {key : str(value) for key, value in ts[variable].attrs.items()}
+                    else:
+                        simulationValues.append(None)
+                values.append(simulationValues)
+        
+        time = numpy.unique(numpy.concatenate(times)) if len(times) > 0 else numpy.asarray([])
+        
+        filename.parent.mkdir( parents=True, exist_ok = True )
+        data = numpy.lib.format.open_memmap(filename, mode = "w+", dtype = dtype,
+                                            shape = (len(variables), len(ids), len(time)))
+        data[:] = numpy.nan
+        
+        for simulationInd, simulationTime in enumerate(times):
+            timeInd = numpy.searchsorted(time, simulationTime)
+            for variableInd, variableValues in enumerate(values[simulationInd]):
+                if variableValues is not None:
+                    data[variableInd, simulationInd, timeInd] = variableValues
+        data.flush()
+        del data
+        
+        FileSystem.writeYAML(filename.with_suffix(".yaml"), {"ids" : [str(simulationID) for simulationID in ids],
+                                                             "variables" : list(variables),
+                                                             "attrs" : attrs,
+                                                             "time" : time.tolist()})
+        
+        return TimeseriesStore(filename)
+    
+    def getIDs(self):
+        return self.ids
+    
+    def getVariables(self):
+        return self.variables
+    
+    def getTime(self, unit = "h"):
+        if unit == "h":
+            return self.time / 3600
+        elif unit == "s":
+            return self.time
+        else:
+            raise ValueError(f"Unknown time unit {unit}")
+    
+    def getVariable(self, variable):
+        """
+        returns a (simulation, time) view of variable
+        """
+        return self.data[self.variableIndex[variable]]
+    
+    def getTimeseries(self, simulationID, variable):
+        return self.data[self.variableIndex[variable], self.idIndex[str(simulationID)]]
+    
+    def getDataArray(self, simulationID, variable, unit = "h"):
+        return xarray.DataArray(self.getTimeseries(simulationID, variable),
+                                dims = "time",
+                                coords = {"time" : self.getTime(unit)},
+                                name = variable,
+                                attrs = self.attrs[variable])